@@ -0,0 +1,55 @@
+import argparse
+from collections import defaultdict
+
+from analysis.utils.metrics import read_metrics
+
+
+METRICS_PATH = '/opt/notebooks/metrics'
+
+
+def slowest_blocks(records, top=20):
+    blocks = [r for r in records if r['stage'] == 'split_annotate']
+    return sorted(blocks, key=lambda r: r['seconds'], reverse=True)[:top]
+
+
+def stage_totals(records):
+    """stage -> (count, errors, total, mean and max seconds), slowest first."""
+    seconds = defaultdict(list)
+    errors = defaultdict(int)
+    for r in records:
+        seconds[r['stage']].append(r['seconds'])
+        errors[r['stage']] += r['status'] != 'ok'
+    totals = {
+        stage: (len(s), errors[stage], sum(s), sum(s) / len(s), max(s))
+        for stage, s in seconds.items()
+    }
+    return dict(sorted(totals.items(), key=lambda item: item[1][2], reverse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rank the slowest blocks and stages of pipeline runs.'
+    )
+    parser.add_argument('paths', nargs='*', default=[METRICS_PATH],
+                        help=f'metrics files or folders (default: {METRICS_PATH})')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    records = read_metrics(args.paths)
+    runs = sorted({r['run'] for r in records})
+    print(f'{len(records)} records from {len(runs)} runs')
+
+    print('\nSlowest blocks')
+    print(f'{"seconds":>10} {"rows":>10} {"bytes":>14}  status  run / block')
+    for r in slowest_blocks(records, args.top):
+        print(f'{r["seconds"]:>10.1f} {r.get("rows", ""):>10} {r.get("bytes", ""):>14}  '
+              f'{r["status"]:<6}  {r["run"]} / {r.get("block")}')
+
+    print('\nStages')
+    print(f'{"total s":>10} {"mean s":>10} {"max s":>10} {"count":>6} {"errors":>6}  stage')
+    for stage, (n, n_errors, total, mean, longest) in list(stage_totals(records).items())[:args.top]:
+        print(f'{total:>10.1f} {mean:>10.1f} {longest:>10.1f} {n:>6} {n_errors:>6}  {stage}')
+
+
+if __name__ == '__main__':
+    main()
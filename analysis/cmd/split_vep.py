@@ -1,47 +1,87 @@
+import os
 import re
-import sys
+import argparse
 import random
-import gzip
-import subprocess
-from math import ceil, floor
-from itertools import chain
-from functools import reduce
 from datetime import datetime
 
-import hail as hl
-import dxpy
-import numpy as np
-from analysis.utils.load_spark import hl_init, SC
-from analysis.utils.dxpathlib import PathDx
+from analysis.utils.load_spark import PLATFORM, PROFILES, hl_init, spark_session
+from analysis.utils.dxpathlib import PathDx, Stager
 from analysis.utils.variant_filtering import VCFFilter
+from analysis.utils.scheduler import BlockScheduler, run_parallel
+from analysis.utils.metrics import metrics
+from analysis.utils.vep import (
+    TRANSCRIPT_FIELDS, ENTRY_FIELDS, slim_vep, slim_mt, write_service_config,
+)
+from analysis.utils.vep_cache import VEPCache
+from analysis.utils.manifest import BlockManifest, file_fingerprint
+from analysis.utils.samples import SampleIndex, restrict_samples, samples_digest
+from analysis.utils.cache import StageCache, fingerprint
+from analysis.utils.batching import parse_memory, plan_batches, rebalance
+from analysis.utils.regions import BlockIndex, to_intervals
+from analysis.utils.masks import MASKS, DEFAULT_MASKS, parse_masks, prefilter, aggregate_masks
+from analysis.utils.export import (
+    FORMATS, SPARSE_FORMATS, ExportProgress, iter_slabs, collect_sparse, export_matrix, export_sparse,
+    export_gene_major,
+)
 
 import pkg_resources
 file_path = pkg_resources.resource_filename('analysis', 'utils/vep-config.json')
 
 
-# Initialize hail
 db_ref = 'wes_mt'
-SC.sql(f"CREATE DATABASE IF NOT EXISTS {db_ref} LOCATION 'dnax://'")
-
-tmp_path = PathDx(database=db_ref)
-
 db_hail_tmp = 'hail_tmp'
-SC.sql(f"CREATE DATABASE IF NOT EXISTS {db_hail_tmp} LOCATION 'dnax://'")
-hail_tmp_path = PathDx(database=db_hail_tmp)
+tmp_path = None
+hail_tmp_path = None
 
-log_path = f'/tmp/{datetime.now().strftime("%Y%m%d-%H%M")}-{random.randrange(16 ** 6):04x}.log'
+run_id = f'{datetime.now().strftime("%Y%m%d-%H%M")}-{random.randrange(16 ** 6):04x}'
+log_path = f'/tmp/{run_id}.log'
 
-hl_init(tmp_dir=hail_tmp_path.rstr, log=log_path)
-
-# Get parameters
 chrs = [str(i) for i in range(1, 23)] + ['X', 'Y']
 eids = None
-if len(sys.argv) > 1:
-    chrs = sys.argv[1].split(',')
-if len(sys.argv) > 2:
-    eids_path = PathDx('/mnt/project/') / sys.argv[2]
-    with open(eids_path) as f:
-        eids = [eid.rstrip() for eid in f.readlines()]
+# Spark settings profile chosen on the command line, see load_spark.PROFILES
+spark_profile = None
+
+# local copy of the block manifest, read by the dry runs
+manifest_cache_path = os.path.expanduser(f'~/.cache/loftee_annot/{db_ref}/{BlockManifest.FILE_NAME}')
+block_index_cache_path = os.path.expanduser(f'~/.cache/loftee_annot/{db_ref}/{BlockIndex.FILE_NAME}')
+
+
+def init(profile=None):
+    """Create the DNAX databases and initialize hail with the Spark
+    settings of ``profile``, see ``load_spark.PROFILES``. Called once, when
+    a stage needs them, so that importing this module has no side
+    effects."""
+    import hail as hl
+    global tmp_path, hail_tmp_path
+    if tmp_path is not None:
+        return
+
+    # Initialize hail; on DNAnexus the databases are created through the
+    # Spark session, which has to start with the profile's settings
+    profile = spark_profile or profile
+    if PLATFORM == 'aws':
+        spark_session(profile)
+    PathDx.create_database(db_ref)
+    tmp_path = PathDx(database=db_ref)
+
+    PathDx.create_database(db_hail_tmp)
+    hail_tmp_path = PathDx(database=db_hail_tmp)
+
+    hl_init(profile, tmp_dir=hail_tmp_path.rstr, log=log_path)
+    metrics.start(f'/opt/notebooks/metrics/{run_id}.jsonl', jvm=hl.spark_context()._jvm)
+
+
+def read_eids(name):
+    with open(PathDx('/mnt/project/') / name) as f:
+        return [eid.rstrip() for eid in f.readlines()]
+
+
+QC_THRESHOLDS = {
+    'min_depth': 7,
+    'min_call_rate': 0.1,
+    'min_p_value': 1e-15,
+    'min_ratio': 0.15,
+}
 
 
 def try_to_int(x):
@@ -60,224 +100,817 @@ def mt_name(contig, block):
     return f'chr-{contig}-b{block}.mt'
 
 
-def match(a, b):
-    b_dict = {x: i for i, x in enumerate(b)}
-    return [b_dict.get(x, None) for x in a]
-
+def vep_path(out, alternate=False):
+    """Path of the VEP annotations of a block annotated with sites_only.
+    Region re-annotation alternates between two paths, as the previous
+    annotations are read while the new ones are written."""
+    return out.with_suffix('.vep-1.ht' if alternate else '.vep.ht')
+
+
+def read_block(path, record):
+    """Read an annotated block, joining its separately stored VEP
+    annotations (see ``sites_only``) if there are any."""
+    import hail as hl
+    mt = hl.read_matrix_table(path.rstr)
+    if record.get('vep_path'):
+        vep_ht = hl.read_table(record['vep_path'])
+        mt = mt.annotate_rows(vep=vep_ht[mt.row_key].vep)
+    return mt
+
+
+def split_annotate(p, out, permit_shuffle=False, vep_config_path=PathDx(file_path), slim=False,
+                   vep_cache=None, contig=None, sites_only=False, intervals=None,
+                   previous_vep=None, out_vep=None, reuse_genotypes=False):
+    """Split and annotate the pVCF block ``p`` into ``out``.
+
+    ``sites_only=True`` writes only the genotypes to ``out``, or reuses
+    them if they are already written and ``reuse_genotypes`` (they come
+    from the same VCF), and the VEP annotations of the sites to a
+    separate table, ``out_vep`` or ``vep_path(out)``.
+
+    With ``intervals`` (and ``sites_only``) only the sites in them are
+    annotated again; the annotations of the other sites are kept from the
+    ``previous_vep`` table or the VEP field of the written block."""
+    import hail as hl
+    if sites_only and reuse_genotypes and hl.hadoop_exists((out / '_SUCCESS').rstr):
+        print(f'....reusing genotypes of {out.name}', flush=True)
+        mt = hl.read_matrix_table(out.rstr)
+    else:
+        mt = hl.import_vcf(
+            p.rstr,
+            force_bgz=True,
+            array_elements_required=False,
+            block_size=128,
+        )
+        mt = hl.split_multi_hts(mt, permit_shuffle=permit_shuffle)
+        if sites_only:
+            if slim:
+                mt = mt.select_entries(*ENTRY_FIELDS)
+            mt.write(out.rstr, overwrite=True)
+            out.invalidate()
+            mt = hl.read_matrix_table(out.rstr)
+
+    if sites_only:
+        sites = mt.rows().select()
+        previous = None
+        if intervals is not None:
+            previous = hl.read_table(previous_vep) if previous_vep else mt.rows().select('vep')
+            sites = hl.filter_intervals(sites, intervals)
+        if vep_cache is not None:
+            vep_ht = vep_cache.lookup(sites, vep_config_path, contig)
+            ht = sites.annotate(vep=vep_ht[sites.key].vep)
+        else:
+            ht = hl.vep(sites, vep_config_path.rstr).select('vep')
+        if slim:
+            ht = ht.annotate(vep=slim_vep(ht.vep))
+        if previous is not None:
+            if ht.vep.dtype != previous.vep.dtype:
+                # e.g. a block annotated with slim, keep the common fields
+                previous_fields = previous.vep.transcript_consequences.dtype.element_type
+                fields = [
+                    field for field in ht.vep.transcript_consequences.dtype.element_type
+                    if field in previous_fields
+                ]
+                ht = ht.annotate(vep=slim_vep(ht.vep, fields))
+                previous = previous.annotate(vep=slim_vep(previous.vep, fields))
+            ht = previous.anti_join(ht).union(ht)
+        out_vep = out_vep or vep_path(out)
+        ht.write(out_vep.rstr, overwrite=True)
+        out_vep.invalidate()
+        return
 
-def split_list(n, k):
-    """Iterate through slices spliting list of length n into k lists of equal
-    size, eg:
-    n = 5, k = 3
-    return: (0, 2), (2, 4), (4, 5)"""
-    avg_length, remainder = divmod(n, k)
-    start = 0
+    if vep_cache is not None:
+        mt = vep_cache.annotate(mt, vep_config_path, contig)
+    else:
+        mt = hl.vep(mt, vep_config_path.rstr)
+    if slim:
+        mt = mt.annotate_rows(vep=slim_vep(mt.vep))
 
-    for i in range(k):
-        end = start + avg_length + (1 if i < remainder else 0)
-        yield start, end
-        start = end
+    mt.write(out.rstr, overwrite=True)
+    out.invalidate()
 
 
-def split_annotate(p, out, permit_shuffle=False, vep_config_path=PathDx(file_path)):
-    mt = hl.import_vcf(
-        p.rstr,
-        force_bgz=True,
-        array_elements_required=False,
-        block_size=128,
+def hadoop_size(path):
+    import hail as hl
+    return sum(
+        hadoop_size(f['path']) if f['is_dir'] else f['size_bytes']
+        for f in hl.hadoop_ls(path)
     )
-    mt = hl.split_multi_hts(mt, permit_shuffle=permit_shuffle)
-    mt = hl.vep(mt, vep_config_path.rstr)
 
-    mt.write(out.rstr, overwrite=True)
+
+def output_stats(path):
+    """Rows, partitions and bytes of a written MatrixTable or Table."""
+    import hail as hl
+    try:
+        if path.name.endswith('.ht'):
+            table = hl.read_table(path.rstr)
+            n_rows = table.count()
+        else:
+            table = hl.read_matrix_table(path.rstr)
+            n_rows = table.count_rows()
+        return {'rows': n_rows, 'partitions': table.n_partitions(), 'bytes': hadoop_size(path.rstr)}
+    except Exception as e:
+        print(f'No stats of {path}: {e}', flush=True)
+        return {}
 
 
-def annotate_vcf():
+def annotate_block(p, out, retries=1, **kwargs):
+    """Annotate one block, retrying up to ``retries`` times with
+    permit_shuffle=True. Return True on success."""
+    def attempt(**extra):
+        with metrics.span('split_annotate', block=out.name, **extra) as span:
+            split_annotate(p, out, **kwargs, **extra)
+            span.update(**output_stats(out))
+
+    try:
+        attempt()
+        return True
+    except Exception as e:
+        print('ERROR: ', p, flush=True)
+        print(e, flush=True)
+    for _ in range(retries):
+        print('Rerunning with permit_shuffle=True', flush=True)
+        try:
+            attempt(permit_shuffle=True)
+            return True
+        except Exception as x:
+            print(x, flush=True)
+    print('SECOND TRY FAILED, PLEASE CHECK FILE MANUALLY', flush=True)
+    return False
+
+
+def vcf_blocks():
+    """Iterate through (path, contig, block) of the pVCF blocks in order."""
     b_vcf = PathDx('/mnt/project/Bulk/Exome sequences/Population level exome OQFE variants, pVCF format - final release')
     b_vcf_files = sorted(b_vcf.listdir(), key=lambda f: nsort(f.name))
     for p in b_vcf_files:
         m = re.fullmatch(r'ukb23157_c(\d{1,2}|X|Y)_b(\d{1,3})_v1.vcf.gz', p.name)
         if m:
-            contig = m.group(1)
-            block = m.group(2)
-            chr_b_path = tmp_path / mt_name(contig, block)
-            if contig in chrs:
-                print(chr_b_path, flush=True)
-                p_local = PathDx(f'/cluster/{p.name}')
-                try:
-                    tmp_paths_list = tmp_path.listdir()
-                except Exception as e:
-                    tmp_paths_list = []
-                if  chr_b_path not in tmp_paths_list:
-                    print(f'Copying {p_local.rstr}...', flush=True)
-                    subprocess.run(['hdfs', 'dfs', '-cp', p.rstr, p_local.rstr], check=True)
-                    p = p_local
-                    try:
-                        split_annotate(p, chr_b_path)
-                    except Exception as e:
-                        print('ERROR: ', p, flush=True)
-                        print(e, flush=True)
-                        print('Rerunning with permit_shuffle=True', flush=True)
-                        try:
-                            split_annotate(p, chr_b_path, permit_shuffle=True)
-                        except Exception as x:
-                            print(x, flush=True)
-                            print('SECOND TRY FAILED, PLEASE CHECK FILE MANUALLY', flush=True)
-                            continue
-                    subprocess.run(
-                        ['hdfs', 'dfs', '-rm', '-r', '-skipTrash', p_local.rstr],
-                        check=True
-                    )
+            yield p, m.group(1), m.group(2)
 
 
-def rare_variants_table():
+def has_success(p):
     try:
-        tmp_paths_list = tmp_path.listdir()
+        return any('_SUCCESS' in file.name for file in p.listdir())
     except Exception as e:
-        print(f'No VCF file is annotated', flush=True)
-        return
-
-    b_vcf = PathDx('/mnt/project/Bulk/Exome sequences/Population level exome OQFE variants, pVCF format - final release')
-    b_vcf_files = sorted(b_vcf.listdir(), key=lambda f: nsort(f.name))
+        return False
+
+
+def load_manifest():
+    """Read the block manifest once; on the first run build it from
+    a single listing of the database."""
+    init()
+    manifest = BlockManifest(tmp_path / BlockManifest.FILE_NAME, cache_path=manifest_cache_path)
+    if not manifest.load():
+        print('No manifest, scanning annotated blocks...', flush=True)
+        try:
+            tmp_paths_list = tmp_path.listdir()
+        except Exception as e:
+            tmp_paths_list = []
+        for p in tmp_paths_list:
+            if p.name.endswith('.mt') and has_success(p):
+                manifest.blocks[p.name] = {'status': 'done', 'path': p.rstr}
+        manifest.save()
+    return manifest
+
+
+def load_cached_manifest():
+    manifest = BlockManifest(None, cache_path=manifest_cache_path)
+    if not manifest.load_cached():
+        print(f'No cached manifest in {manifest_cache_path}, '
+              'all blocks are shown as not annotated', flush=True)
+    return manifest
+
+
+def load_block_index(manifest):
+    """Read the block index; blocks missing in it are indexed from the
+    tabix indices of their pVCF files or, without one, from the metadata
+    of the annotated blocks."""
+    index = BlockIndex(tmp_path / BlockIndex.FILE_NAME, cache_path=block_index_cache_path)
+    index.load()
+    added = False
+    for p, contig, block in vcf_blocks():
+        name = mt_name(contig, block)
+        if name in index.blocks:
+            continue
+        if index.add_vcf(name, p):
+            added = True
+        elif manifest.is_done(name):
+            index.add_mt(name, manifest.get(name)['path'], n_rows=manifest.get(name).get('n_rows'))
+            added = True
+    if added:
+        index.save()
+    return index
+
+
+def load_cached_block_index():
+    index = BlockIndex(None, cache_path=block_index_cache_path)
+    if not index.load_cached():
+        print(f'No cached block index in {block_index_cache_path}', flush=True)
+    return index
+
+
+def select_blocks(index, regions, manifest=None):
+    """Regions and block names of a selection, see ``BlockIndex.select``.
+    With ``manifest``, genes which aren't found make the annotated blocks
+    be scanned once for their genes."""
+    try:
+        return index.select(regions)
+    except ValueError:
+        if manifest is None:
+            raise
+    print('Scanning the genes of the annotated blocks...', flush=True)
+    for name, record in manifest.blocks.items():
+        if record.get('status') != 'done' or 'genes' in index.blocks.get(name, {'genes': {}}):
+            continue
+        ht = read_block(tmp_path / name, record).rows()
+        index.add_genes(name, ht.select(vep=slim_vep(ht.vep)))
+    index.save()
+    return index.select(regions)
+
+
+def pending_blocks(manifest, reannotate=False, selected=None):
+    """(path, contig, block name) of the blocks of ``chrs`` to annotate,
+    all ``selected`` blocks if it is given."""
+    pending = []
+    for p, contig, block in vcf_blocks():
+        name = mt_name(contig, block)
+        if contig not in chrs:
+            continue
+        if selected is not None:
+            if name in selected:
+                pending.append((p, contig, name))
+        elif not manifest.is_done(name) or (reannotate and manifest.get(name).get('vep_path')):
+            pending.append((p, contig, name))
+    return pending
+
+
+def ready_chromosomes(manifest, selected=None):
+    """Chromosome -> block names of the chromosomes of ``chrs`` whose
+    blocks, or ``selected`` blocks if it is given, are all annotated."""
+    blocks = list(vcf_blocks())
+    ready = {}
     for chrom in chrs:
         print(f'Chr {chrom}')
         out_mts = []
-        for p in b_vcf_files:
-            m = re.fullmatch(r'ukb23157_c(\d{1,2}|X|Y)_b(\d{1,3})_v1.vcf.gz', p.name)
-            if m:
-                contig = m.group(1)
-                block = m.group(2)
-                chr_b_path = tmp_path / mt_name(contig, block)
-                if contig == chrom:
-                    if chr_b_path in tmp_paths_list:
-                        try:
-                            has_success = any(
-                                '_SUCCESS' in file.name
-                                for file in chr_b_path.listdir()
-                            )
-                        except Exception as e:
-                            has_success = False
-                        if has_success:
-                            print(f'{chr_b_path} OK', flush=True)
-                            out_mts.append(chr_b_path)
-                        else:
-                            print(f'{chr_b_path} FAIL (no _SUCCESS)', flush=True)
-                            out_mts.append(False)
-                    else:
-                        print(f'{chr_b_path} FAIL (no file)', flush=True)
-                        out_mts.append(False)
+        for p, contig, block in blocks:
+            name = mt_name(contig, block)
+            if contig == chrom and (selected is None or name in selected):
+                status = manifest.get(name).get('status')
+                if status == 'done':
+                    print(f'{name} OK', flush=True)
+                    out_mts.append(name)
+                elif status is None:
+                    print(f'{name} FAIL (no file)', flush=True)
+                    out_mts.append(False)
+                else:
+                    print(f'{name} FAIL ({status})', flush=True)
+                    out_mts.append(False)
+        if not out_mts:
+            continue
         if all(out_mts):
-            _chr_table(chrom, out_mts, eids)
+            ready[chrom] = out_mts
         else:
             print(f'Some VCF files are not ready', flush=True)
+    return ready
+
+
+def annotate_vcf(n_workers=1, n_prefetch=1, retries=1, slim=False,
+                 vep_service=False, vep_workers=4, vep_batch_size=5000, use_vep_cache=True,
+                 sites_only=False, reannotate=False, staging='auto', staging_budget=200 * 2 ** 30,
+                 regions=None, dry_run=False):
+    """Annotate all blocks of ``chrs`` which are not annotated yet.
+
+    ``n_workers`` blocks are annotated at once while up to ``n_prefetch``
+    next blocks are copied to /cluster/ in the background. ``slim=True``
+    stores only the VEP fields used for the LoF tables. ``vep_service=True``
+    streams variants through ``vep_workers`` long-lived VEP processes per
+    node in requests of ``vep_batch_size`` variants. With ``use_vep_cache``
+    only variants without cached VEP results are sent to VEP.
+
+    ``sites_only=True`` stores genotypes and VEP annotations separately,
+    see ``split_annotate``; ``reannotate=True`` then reruns VEP for blocks
+    annotated this way without rewriting their genotypes.
+
+    ``staging`` chooses how the executors read the pVCF blocks, see
+    ``Stager``: 'direct' from /mnt/project, 'copy' through /cluster/ with
+    at most ``staging_budget`` bytes of copies, or 'auto'.
+
+    ``regions`` (intervals, BED files, block ids or gene names, see
+    ``BlockIndex.select``) restricts the run to the overlapping blocks;
+    in the annotated ones only the sites in the regions are annotated
+    again, see ``split_annotate``.
+
+    ``dry_run=True`` only lists the blocks to annotate, using the local
+    copy of the manifest, without starting Spark."""
+    if dry_run:
+        selected = select_blocks(load_cached_block_index(), regions)[1] if regions else None
+        pending = pending_blocks(load_cached_manifest(), reannotate, selected)
+        for p, contig, name in pending:
+            print(f'{name} <- {p}', flush=True)
+        print(f'{len(pending)} blocks to annotate', flush=True)
+        return pending
+
+    import hail as hl
+    init('annotate')
+    sites_only = sites_only or reannotate
+    vep_config_path = PathDx(file_path)
+    if vep_service:
+        vep_config_path = PathDx(write_service_config(
+            '/tmp/vep-service-config.json', file_path,
+            workers=vep_workers, batch_size=vep_batch_size,
+        ))
+    vep_cache = VEPCache(tmp_path, file_path) if use_vep_cache else None
+    manifest = load_manifest()
+    sample_index = SampleIndex(tmp_path, manifest)
+    selected, intervals = None, None
+    if regions:
+        region_list, selected = select_blocks(load_block_index(manifest), regions, manifest)
+        intervals = to_intervals(region_list)
+        print(f'{len(selected)} blocks overlap the regions', flush=True)
+
+    stager = Stager(staging, budget=staging_budget, sc=hl.spark_context())
+
+    pending = [
+        (p, contig, tmp_path / name)
+        for p, contig, name in pending_blocks(manifest, reannotate, selected)
+    ]
+
+    def genotypes_written(p, name):
+        """Whether the genotypes of block ``name`` were written from the
+        VCF ``p`` as it is now. Blocks annotated before the genotypes
+        had their own checksum have the one of the annotated block."""
+        record = manifest.get(name)
+        checksum = record.get('genotypes_checksum')
+        if checksum is None and record.get('status') == 'done':
+            checksum = record.get('checksum')
+        return checksum == file_fingerprint(p)
+
+    def stage(item):
+        p, contig, chr_b_path = item
+        if not manifest.is_done(chr_b_path.name) or not genotypes_written(p, chr_b_path.name):
+            return stager.stage(p)
+        if intervals is not None or (reannotate and manifest.get(chr_b_path.name).get('vep_path')):
+            # the genotypes are already written, the VCF isn't read
+            return None
+        return stager.stage(p)
+
+    def process(item, p_local):
+        p, contig, chr_b_path = item
+        print(chr_b_path, flush=True)
+        reuse_genotypes = genotypes_written(p, chr_b_path.name)
+        # annotated blocks are annotated again only in the regions, unless
+        # their VCF changed
+        block_intervals = intervals if manifest.is_done(chr_b_path.name) and reuse_genotypes else None
+        previous_vep, out_vep = None, None
+        if block_intervals is not None:
+            previous_vep = manifest.get(chr_b_path.name).get('vep_path')
+            out_vep = vep_path(chr_b_path, alternate=previous_vep == vep_path(chr_b_path).rstr)
+        block_sites_only = sites_only or block_intervals is not None
+        checksum = file_fingerprint(p)
+        started = datetime.now()
+        manifest.update(chr_b_path.name, status='running', started=started.isoformat(timespec='seconds'))
+        ok = annotate_block(
+            p_local, chr_b_path, retries=retries,
+            slim=slim, vep_config_path=vep_config_path,
+            vep_cache=vep_cache, contig=contig, sites_only=block_sites_only,
+            intervals=block_intervals, previous_vep=previous_vep, out_vep=out_vep,
+            reuse_genotypes=reuse_genotypes,
+        )
+        finished = datetime.now()
+        record = {
+            'status': 'failed',
+            'path': chr_b_path.rstr,
+            'checksum': checksum,
+            'finished': finished.isoformat(timespec='seconds'),
+            'seconds': (finished - started).total_seconds(),
+        }
+        if ok:
+            n_rows, n_cols = hl.read_matrix_table(chr_b_path.rstr).count()
+            record.update(status='done', n_rows=n_rows, n_cols=n_cols)
+            record['vep_path'] = (out_vep or vep_path(chr_b_path)).rstr if block_sites_only else None
+            record['genotypes_checksum'] = checksum
+        manifest.update(chr_b_path.name, **record)
+        if ok:
+            sample_index.record(chr_b_path.name, chr_b_path)
+        return ok
+
+    def release(item, p_local):
+        if p_local is not None:
+            stager.release(p_local)
+
+    scheduler = BlockScheduler(n_workers=n_workers, n_prefetch=n_prefetch)
+    results = scheduler.run(pending, process, stage=stage, release=release)
+    if vep_cache is not None:
+        vep_cache.remove_merged()
+    failed = [chr_b_path for (p, contig, chr_b_path), ok in results.items() if ok is not True]
+    for chr_b_path in failed:
+        print(f'{chr_b_path} FAIL', flush=True)
+
+
+def rare_variants_table(output_format='csv', sparse=False, single_pass=False, checkpoint=True,
+                        n_chr_workers=1, masks=None, regions=None, dry_run=False):
+    """Build the LoF tables of all ready chromosomes of ``chrs``, running
+    up to ``n_chr_workers`` chromosome pipelines at once, one table per
+    mask of ``masks`` (see ``masks.Mask``). ``regions`` (see
+    ``BlockIndex.select``) restricts the tables to the variants in them,
+    read only from the overlapping blocks.
+
+    ``dry_run=True`` only lists the chromosomes which would be built, in
+    order, using the local copy of the manifest, without starting Spark."""
+    if not dry_run:
+        init('aggregate')
+    manifest = load_cached_manifest() if dry_run else load_manifest()
+    if not manifest.blocks:
+        print(f'No VCF file is annotated', flush=True)
+        return
 
+    selected, intervals = None, None
+    if regions:
+        if dry_run:
+            region_list, selected = select_blocks(load_cached_block_index(), regions)
+        else:
+            region_list, selected = select_blocks(load_block_index(manifest), regions, manifest)
+            intervals = to_intervals(region_list)
+    ready = ready_chromosomes(manifest, selected)
+    # start with the largest chromosomes so that the small ones fill the tail
+    n_rows = {
+        chrom: sum(manifest.get(name).get('n_rows', 0) for name in names)
+        for chrom, names in ready.items()
+    }
+    order = sorted(ready, key=n_rows.get, reverse=True)
+    if dry_run:
+        for chrom in order:
+            print(f'Chr {chrom}: {len(ready[chrom])} blocks, {n_rows[chrom]} variants', flush=True)
+        return order
+
+    sample_index = SampleIndex(tmp_path, manifest)
+    ready = {chrom: [tmp_path / name for name in names] for chrom, names in ready.items()}
+
+    def chr_table(chrom):
+        return _chr_table(
+            chrom, ready[chrom], eids,
+            output_format=output_format, sparse=sparse,
+            single_pass=single_pass, checkpoint=checkpoint,
+            masks=masks, intervals=intervals, sample_index=sample_index,
+        )
 
-def _chr_table(chrom, mts, eids):
+    results = run_parallel(order, chr_table, n_workers=n_chr_workers)
+    for chrom, result in results.items():
+        if isinstance(result, Exception):
+            print(f'Chr {chrom} FAIL', flush=True)
+
+
+def _chr_table(chrom, mts, eids, output_format='csv', sparse=False,
+               single_pass=False, checkpoint=True, fused_qc=True, export_threads=4,
+               masks=None, intervals=None, sample_index=None, work_dir='/cluster',
+               out_dir='/opt/notebooks'):
+    """Build the samples x genes LoF tables of a chromosome from its blocks.
+
+    Every mask of ``masks``, by default the HC LoF dosage, is aggregated in
+    the same ``group_rows_by`` and exported as its own table, named with the
+    mask's name if there are several. With ``intervals`` only the
+    partitions of the blocks overlapping them are read.
+
+    Sparse output formats, or ``sparse=True``, collect only the non-zero
+    entries and skip the dense BlockMatrix; dense formats are then derived
+    from them. ``single_pass=True`` aggregates genes and writes a gene-major
+    CSV, transposed to the other outputs (one line per gene, one column
+    per sample), in one distributed pass: the samples come from the sample
+    index and the genes from the batch outputs. ``checkpoint=False``
+    skips the intermediate checkpoints before and after the aggregation.
+    ``fused_qc=False`` applies the VCFFilter steps one by one instead of
+    the single QC aggregation. Intermediate results are written to
+    ``work_dir`` and the tables to ``out_dir``."""
+    import hail as hl
+    if single_pass and (sparse or output_format != 'csv'):
+        raise ValueError('single_pass writes only the gene-major csv output.')
+    masks = masks or [MASKS[name] for name in DEFAULT_MASKS]
     print('Unifying colnames...', flush=True)
-    mts_dict = {b: hl.read_matrix_table(b.rstr) for b in mts}
-    mts_patients = {b: mt.s.collect() for b, mt in mts_dict.items()}
-    common_pats = reduce(lambda x, y: x & y, (set(p) for p in mts_patients.values()))
-    if eids:
-        common_pats &= set(eids)
-    mts_unified = []
-    for b, pats in mts_patients.items():
-        pat_indices = match(list(common_pats), pats)
-        mts_unified.append(mts_dict[b].choose_cols(pat_indices))
+    if sample_index is None:
+        manifest = load_manifest()
+        sample_index = SampleIndex(tmp_path, manifest)
+    mts_dict = {
+        b.name: (b, read_block(b, sample_index.manifest.get(b.name))) for b in mts
+    }
+    # eids are selected after the column independent stage, see below
+    mts_unified = [
+        slim_mt(mt) for mt in sample_index.harmonize(mts_dict).values()
+    ]
+    if intervals is not None:
+        mts_unified = [hl.filter_intervals(mt, intervals) for mt in mts_unified]
 
     # out table
-    min_batch = 19
-    n, k = len(mts), max(1, floor(len(mts) / min_batch))
+    manifest = sample_index.manifest
+    blocks_meta = []
+    for b, (path, mt) in mts_dict.items():
+        record = manifest.get(b)
+        if 'n_rows' in record and 'n_cols' in record:
+            n_rows, n_cols = record['n_rows'], record['n_cols']
+        else:
+            n_rows, n_cols = mt.count()
+        if eids:
+            n_cols = min(n_cols, len(eids))
+        blocks_meta.append((n_rows, n_cols, mt.n_partitions()))
+    n_cols = min(meta[1] for meta in blocks_meta)
+    batches = plan_batches(blocks_meta)
+
+    # Batch outputs are cached by their inputs: the LoF rows of a batch by
+    # its blocks and their annotation time, the QC annotated rows also by
+    # the thresholds and the selected eids.
+    cache = StageCache(PathDx(work_dir) / 'cache')
+    block_ids = list(mts_dict)
+    all_samples = sorted({manifest.get(b).get('samples') or '' for b in block_ids})
+    eids_key = samples_digest(sorted(set(eids))) if eids else None
+    mt_filter = VCFFilter()
     all_gene_names = set()
-    for i, (start, end) in enumerate(split_list(n, k)):
-        print(f'Part {i}: [{start}:{end}]', flush=True)
-        mt_lof = hl.MatrixTable.union_rows(*mts_unified[start:end])
-
-        CANONICAL = 1
-        mt_lof = mt_lof.explode_rows(
-            mt_lof.vep.transcript_consequences
-        )
-        mt_lof = mt_lof.filter_rows(
-            (mt_lof.vep.transcript_consequences.canonical == CANONICAL)
-            & (mt_lof.vep.transcript_consequences.biotype == 'protein_coding')
-        )
-        mt_lof = mt_lof.annotate_rows(
-            gene_name=hl.if_else(
-                hl.is_defined(mt_lof.vep.transcript_consequences.gene_symbol),
-                mt_lof.vep.transcript_consequences.gene_symbol,
-                mt_lof.vep.transcript_consequences.gene_id
-            )
-        )
-        print('....aggregating names', flush=True)
-        all_gene_names |= mt_lof.aggregate_rows(hl.agg.collect_as_set(mt_lof.gene_name))
-
-        print('....filtering', flush=True)
-        mt_lof = mt_lof.filter_rows(
-            hl.is_defined(mt_lof.vep.transcript_consequences.lof)
+    part_paths = []
+    qc_keys = []
+    part_rows = []
+    part_genes = []
+    for i, (start, end) in enumerate(batches):
+        lof_key = fingerprint(
+            'lof', TRANSCRIPT_FIELDS, all_samples,
+            sorted((mask.lof, mask.consequences) for mask in masks),
+            [str(interval) for interval in intervals] if intervals is not None else None,
+            [(b, manifest.get(b).get('finished'), manifest.get(b).get('checksum'))
+             for b in block_ids[start:end]],
         )
+        lof_path, lof_info = cache.lookup('lof', lof_key)
+        if lof_info is None:
+            print(f'Part {i}: [{start}:{end}]', flush=True)
+            with metrics.span(
+                'lof', chrom=chrom, batch=i, blocks=end - start,
+                rows_in=sum(meta[0] for meta in blocks_meta[start:end]),
+            ) as span:
+                mt_lof = hl.MatrixTable.union_rows(*mts_unified[start:end])
+
+                # transcripts are already canonical protein coding, see slim_mt
+                mt_lof = mt_lof.explode_rows(
+                    mt_lof.vep.transcript_consequences
+                )
+                mt_lof = mt_lof.annotate_rows(
+                    gene_name=hl.if_else(
+                        hl.is_defined(mt_lof.vep.transcript_consequences.gene_symbol),
+                        mt_lof.vep.transcript_consequences.gene_symbol,
+                        mt_lof.vep.transcript_consequences.gene_id
+                    )
+                )
+                print('....aggregating names', flush=True)
+                gene_names = mt_lof.aggregate_rows(hl.agg.collect_as_set(mt_lof.gene_name))
+
+                print('....filtering', flush=True)
+                mt_lof = mt_lof.filter_rows(
+                    prefilter(masks, mt_lof.vep.transcript_consequences)
+                )
+                mt_lof = mt_lof.filter_rows(~mt_lof.was_split)
+                mt_lof.write(lof_path.rstr, overwrite=True)
+                lof_info = cache.save(lof_path, {'gene_names': sorted(gene_names)})
+                span.update(genes=len(gene_names), **output_stats(lof_path))
+        else:
+            print(f'Part {i}: [{start}:{end}] cached', flush=True)
+        all_gene_names |= set(lof_info['gene_names'])
 
         # Filter VCF
-        mt_filter = VCFFilter()
-        mt_lof = mt_filter.mean_read_depth(mt_lof, min_depth=7)
-        mt_lof = hl.variant_qc(mt_lof)
-        mt_lof = mt_filter.variant_missingness(mt_lof, min_ratio=0.1)
-        mt_lof = mt_filter.hardy_weinberg(mt_lof, min_p_value=1e-15)
-        mt_lof = mt_filter.allele_balance(mt_lof, n_sample=1, min_ratio=0.15)
-        mt_lof = mt_lof.filter_rows(~mt_lof.was_split)
-        mt_lof.write(PathDx(f'/cluster/result-{chrom}-0-p{i}').rstr, overwrite=True)
-
-    print('Unioning all', flush=True)
-    mt_lof = hl.MatrixTable.union_rows(
-        *[
-            hl.read_matrix_table(PathDx(f'/cluster/result-{chrom}-0-p{i}').rstr)
-            for i in range(k)
-        ]
-    )
-    mt_lof = mt_lof.checkpoint(PathDx(f'/cluster/result-{chrom}-0').rstr, overwrite=True)
-
-    mt_lof_grouped = mt_lof.group_rows_by(mt_lof.gene_name)
-    result = mt_lof_grouped.aggregate_entries(
-        hc_lof_hom_n=hl.agg.max(mt_lof.GT.n_alt_alleles() * (mt_lof.vep.transcript_consequences.lof == 'HC')),
-        hc_lof_n_het=hl.agg.sum(mt_lof.GT.is_het() * (mt_lof.vep.transcript_consequences.lof == 'HC')),
-        any_lof_hom_n=hl.agg.max(mt_lof.GT.n_alt_alleles()),
-        any_lof_n_het=hl.agg.sum(mt_lof.GT.is_het()),
-        n_non_ref=hl.agg.sum(mt_lof.GT.is_non_ref()),
-    ).result()
-    result = result.transmute_entries(
-        hc_lof_hom=hl.if_else(result.hc_lof_hom_n == 2, True, False, missing_false=True),
-        any_lof_hom=hl.if_else(result.any_lof_hom_n == 2, True, False, missing_false=True),
+        qc_key = fingerprint('qc', lof_key, eids_key, fused_qc, QC_THRESHOLDS)
+        qc_path, qc_info = cache.lookup('qc', qc_key)
+        if qc_info is None:
+            with metrics.span('qc', chrom=chrom, batch=i, fused=fused_qc) as span:
+                mt_lof = hl.read_matrix_table(lof_path.rstr)
+                if eids:
+                    mt_lof = restrict_samples(mt_lof, eids)
+                if fused_qc:
+                    mt_lof = mt_filter.annotate_qc(mt_lof, **QC_THRESHOLDS)
+                    mt_lof.write(qc_path.rstr, overwrite=True)
+                    mt_qc = hl.read_matrix_table(qc_path.rstr)
+                    drop_counts = mt_filter.qc_drop_counts(mt_qc, pass_genes=mt_qc.gene_name)
+                    print(f'....QC dropped: {drop_counts.drop("genes")}', flush=True)
+                    n_rows, genes = drop_counts.n_pass, drop_counts.genes
+                else:
+                    mt_lof = mt_filter.mean_read_depth(mt_lof, min_depth=QC_THRESHOLDS['min_depth'])
+                    mt_lof = hl.variant_qc(mt_lof)
+                    mt_lof = mt_filter.variant_missingness(
+                        mt_lof, min_ratio=QC_THRESHOLDS['min_call_rate']
+                    )
+                    mt_lof = mt_filter.hardy_weinberg(
+                        mt_lof, min_p_value=QC_THRESHOLDS['min_p_value']
+                    )
+                    mt_lof = mt_filter.allele_balance(
+                        mt_lof, n_sample=1, min_ratio=QC_THRESHOLDS['min_ratio']
+                    )
+                    mt_lof.write(qc_path.rstr, overwrite=True)
+                    mt_qc = hl.read_matrix_table(qc_path.rstr)
+                    n_rows, genes = mt_qc.aggregate_rows(
+                        (hl.agg.count(), hl.agg.collect_as_set(mt_qc.gene_name))
+                    )
+                # the genes of the aggregated result, for the single pass export
+                qc_info = cache.save(qc_path, {'n_rows': n_rows, 'gene_names': sorted(genes)})
+                span.update(rows_out=n_rows, **output_stats(qc_path))
+        part_paths.append(qc_path)
+        qc_keys.append(qc_key)
+        part_rows.append(qc_info['n_rows'])
+        part_genes.append(qc_info.get('gene_names'))
+
+    # The union, the aggregated result and the block matrices are cached
+    # like the batches, so that a rerun continues after the last complete
+    # stage; the exports record their progress, see ExportProgress.
+    union_key = fingerprint('union', qc_keys)
+    union_path, union_info = cache.lookup('union', union_key)
+    if checkpoint and union_info is not None:
+        print('Union cached', flush=True)
+        mt_lof = hl.read_matrix_table(union_path.rstr)
+    else:
+        print('Unioning all', flush=True)
+        with metrics.span('union', chrom=chrom, parts=len(part_paths), rows=sum(part_rows)) as span:
+            mts_parts = [hl.read_matrix_table(path.rstr) for path in part_paths]
+            if fused_qc:
+                mts_parts = [mt_filter.apply_qc(mt) for mt in mts_parts]
+            mt_lof = hl.MatrixTable.union_rows(*mts_parts)
+            mt_lof = rebalance(mt_lof, sum(part_rows), n_cols)
+            if checkpoint:
+                mt_lof = mt_lof.checkpoint(union_path.rstr, overwrite=True)
+                cache.save(union_path, {'partitions': mt_lof.n_partitions()})
+            span.update(partitions=mt_lof.n_partitions())
+
+    # one entry field per mask
+    result_key = fingerprint('result', union_key, [mask.spec() for mask in masks])
+    result_path, result_info = cache.lookup('result', result_key)
+    if checkpoint and result_info is not None:
+        print('Aggregated result cached', flush=True)
+        result = hl.read_matrix_table(result_path.rstr)
+    else:
+        result = aggregate_masks(mt_lof, masks)
+    # reruns with the same inputs write, or continue, the same files
+    out_prefix = f'{out_dir}/out-{chrom}-{result_key[:6]}'
+
+    def mask_prefix(mask):
+        return out_prefix if len(masks) == 1 else f'{out_prefix}-{mask.name}'
+
+    def exported(progress, out_path):
+        if progress.load()[2]:
+            print(f'Reusing {out_path}', flush=True)
+            return True
+        return False
+
+    # aggregation and export, the aggregation is only run by the export
+    with metrics.span('export', chrom=chrom, format=output_format, masks=len(masks)) as span:
+        if checkpoint and result_info is None and (not single_pass or len(masks) > 1):
+            # the masks are exported one by one from the aggregated result
+            result = result.checkpoint(result_path.rstr, overwrite=True)
+            result_info = cache.save(result_path, {'masks': [mask.name for mask in masks]})
+        out_paths = []
+
+        if single_pass:
+            print('Export genes to csv', flush=True)
+            # no pass over the result besides the export itself
+            patients = sample_index.columns(block_ids, eids)
+            if any(genes is None for genes in part_genes):
+                # batches cached before their genes were recorded
+                lof_gene_names = mt_lof.aggregate_rows(hl.agg.collect_as_set(mt_lof.gene_name))
+            else:
+                lof_gene_names = set().union(*part_genes)
+            zero_genes = all_gene_names - lof_gene_names
+            for mask in masks:
+                out_path = f'{mask_prefix(mask)}-genes.csv.gz'
+                progress = ExportProgress(out_path, fingerprint(result_key, mask.name, 'genes'))
+                if not exported(progress, out_path):
+                    export_gene_major(
+                        result, out_path,
+                        PathDx(work_dir) / f'result-{chrom}-{mask.name}-lines.tsv.bgz',
+                        patients, sorted(zero_genes),
+                        field=mask.name, n_threads=export_threads,
+                    )
+                    progress.complete()
+                    print(f'Saved {out_path}', flush=True)
+                out_paths.append(out_path)
+            span.update(paths=out_paths)
+            return
+
+        patients = result.s.collect()
+        gene_names = result.gene_name.collect()
+        zero_genes = all_gene_names - set(gene_names)
+
+        if sparse or output_format in SPARSE_FORMATS:
+            for mask in masks:
+                out_path = mask_prefix(mask) + FORMATS[output_format]
+                progress = ExportProgress(
+                    out_path, fingerprint(result_key, mask.name, output_format)
+                )
+                if not exported(progress, out_path):
+                    print(f'Collecting non-zero entries of {mask.name}', flush=True)
+                    coo = collect_sparse(result, mask.name)
+                    print(f'Export to {output_format}', flush=True)
+                    export_sparse(
+                        output_format, mask_prefix(mask), patients, gene_names,
+                        list(zero_genes), coo,
+                        n_threads=export_threads,
+                    )
+                    progress.complete()
+                    print(f'Saved {out_path}', flush=True)
+                out_paths.append(out_path)
+            span.update(paths=out_paths)
+            return
+
+        block_size = 512
+        for mask in masks:
+            out_path = mask_prefix(mask) + FORMATS[output_format]
+            bm_key = fingerprint('bm', result_key, mask.name, block_size)
+            progress = ExportProgress(out_path, fingerprint(bm_key, output_format))
+            if exported(progress, out_path):
+                out_paths.append(out_path)
+                continue
+            result_bm_path, bm_info = cache.lookup('bm', bm_key, suffix='.bm')
+            if bm_info is None:
+                print(f'Save {mask.name} as block matrix', flush=True)
+                hl.linalg.BlockMatrix.write_from_entry_expr(
+                    result[mask.name], result_bm_path.rstr, block_size=block_size, overwrite=True
+                )
+                cache.save(result_bm_path, {'mask': mask.name})
+            arr = hl.linalg.BlockMatrix.read(result_bm_path.rstr)
+
+            print(f'Export to {output_format}', flush=True)
+            arr_t = arr.T
+            assert len(patients) == arr_t.shape[0]
+            assert len(gene_names) == arr_t.shape[1]
+            # an interrupted csv export continues after its last slab
+            first_row = progress.load()[0] if output_format == 'csv' else 0
+            if first_row:
+                print(f'....continuing from row {first_row}', flush=True)
+            export_matrix(
+                output_format, mask_prefix(mask),
+                patients, gene_names, list(zero_genes),
+                iter_slabs(arr_t, slab_size=block_size * 100, first_row=first_row),
+                n_threads=export_threads, progress=progress if output_format == 'csv' else None,
+            )
+            progress.complete()
+            print(f'Saved {out_path}', flush=True)
+            out_paths.append(out_path)
+        span.update(paths=out_paths)
+
+
+def parser(description):
+    """Argument parser with the selection common to the entry points."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('chrs', nargs='?', help='comma separated chromosomes, all by default')
+    parser.add_argument('eids', nargs='?', help='file with the sample ids to keep, relative to /mnt/project/')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only show what would run, from the local copy of the manifest')
+    parser.add_argument('--regions', type=lambda value: value.split(','),
+                        help='comma separated intervals (chr1:1000-2000), BED files, block ids or genes')
+    parser.add_argument('--profile', choices=list(PROFILES),
+                        help='Spark settings profile instead of the stage default')
+    return parser
+
+
+def set_selection(args):
+    global chrs, eids, spark_profile
+    spark_profile = args.profile
+    if args.chrs:
+        chrs = args.chrs.split(',')
+    if args.eids:
+        eids = read_eids(args.eids)
+
+
+def main_annotate_vcf():
+    p = parser('Split the pVCF blocks and annotate them with VEP and LOFTEE.')
+    p.add_argument('--workers', type=int, default=1, help='blocks annotated at once')
+    p.add_argument('--prefetch', type=int, default=1, help='blocks staged ahead')
+    p.add_argument('--retries', type=int, default=1, help='retries with permit_shuffle')
+    p.add_argument('--slim', action='store_true', help='keep only the fields used for the LoF tables')
+    p.add_argument('--vep-service', action='store_true', help='long-lived VEP workers per node')
+    p.add_argument('--vep-workers', type=int, default=4)
+    p.add_argument('--vep-batch-size', type=int, default=5000)
+    p.add_argument('--no-vep-cache', dest='use_vep_cache', action='store_false')
+    p.add_argument('--sites-only', action='store_true', help='store VEP results apart from genotypes')
+    p.add_argument('--reannotate', action='store_true', help='rerun VEP of sites-only blocks')
+    p.add_argument('--staging', choices=Stager.MODES, default='auto')
+    p.add_argument('--staging-budget', type=parse_memory, default='200g')
+    args = p.parse_args()
+    set_selection(args)
+    annotate_vcf(
+        n_workers=args.workers, n_prefetch=args.prefetch, retries=args.retries, slim=args.slim,
+        vep_service=args.vep_service, vep_workers=args.vep_workers,
+        vep_batch_size=args.vep_batch_size, use_vep_cache=args.use_vep_cache,
+        sites_only=args.sites_only, reannotate=args.reannotate,
+        staging=args.staging, staging_budget=args.staging_budget,
+        regions=args.regions, dry_run=args.dry_run,
     )
 
-    result = result.annotate_entries(
-        value=hl.if_else(
-            result.hc_lof_hom,
-            2,
-            hl.min(result.hc_lof_n_het, 2)
-        )
+
+def main_rare_variants_table():
+    p = parser('Build the samples x genes LoF tables of the annotated chromosomes.')
+    p.add_argument('--format', choices=list(FORMATS), default='csv')
+    p.add_argument('--sparse', action='store_true', help='collect only the non-zero entries')
+    p.add_argument('--single-pass', action='store_true',
+                   help='TRANSPOSED gene-major csv (a line per gene, a column per sample) in one pass')
+    p.add_argument('--no-checkpoint', dest='checkpoint', action='store_false')
+    p.add_argument('--chr-workers', type=int, default=1, help='chromosomes built at once')
+    p.add_argument('--masks', type=parse_masks, default=','.join(DEFAULT_MASKS),
+                   help=f'comma separated masks ({", ".join(MASKS)}) or a JSON file of mask specs')
+    args = p.parse_args()
+    set_selection(args)
+    rare_variants_table(
+        output_format=args.format, sparse=args.sparse, single_pass=args.single_pass,
+        checkpoint=args.checkpoint, n_chr_workers=args.chr_workers, masks=args.masks,
+        regions=args.regions, dry_run=args.dry_run,
     )
-    result = result.checkpoint(PathDx(f'/cluster/result-{chrom}-1b').rstr, overwrite=True)
-
-    result_bm_path = PathDx(f'/cluster/result-{chrom}.bm')
-    block_size = 512
-    print('Save as block matrix', flush=True)
-    hl.linalg.BlockMatrix.write_from_entry_expr(result.value, result_bm_path.rstr, block_size=block_size, overwrite=True)
-    arr = hl.linalg.BlockMatrix.read(result_bm_path.rstr)
-
-    print('Export to csv', flush=True)
-    patients = result.s.collect()
-    gene_names = result.gene_name.collect()
-    zero_genes = all_gene_names - set(gene_names)
-
-    arr_t = arr.T
-    blocks = 512 * 100
-    out_path = f'/opt/notebooks/out-{chrom}-{random.randrange(16 ** 6):04x}.csv.gz'
-    with gzip.open(out_path, 'wt') as f:
-        assert len(patients) == arr_t.shape[0]
-        assert len(gene_names) == arr_t.shape[1]
-        f.write(f"s,{','.join(chain(gene_names, zero_genes))}\n")
-        for b in range(ceil(arr_t.shape[0] / blocks)):
-            start = b * blocks
-            end = min((b + 1) * blocks, arr_t.shape[0])
-            arr_np = arr_t[start:end, :].to_numpy().astype(np.int8)
-            for i in range(arr_np.shape[0]):
-                line = f"{patients[i + start]},{','.join(chain(map(str, arr_np[i, :]), '0' * len(zero_genes)))}\n"
-                f.write(line)
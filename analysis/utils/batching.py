@@ -0,0 +1,68 @@
+import re
+from math import ceil
+
+
+# rough in-memory size of one GT/DP/AD entry
+BYTES_PER_ENTRY = 16
+UNITS = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+
+
+def parse_memory(value):
+    """Parse a Spark memory string such as '80G' or '512m' to bytes."""
+    m = re.fullmatch(r'(\d+)([kmgt]?)b?', value.strip().lower())
+    if not m:
+        raise ValueError(f'Unknown memory size: {value}')
+    return int(m.group(1)) * UNITS.get(m.group(2), 1)
+
+
+def cluster_resources():
+    """Return (executor memory in bytes, number of executors, total cores)."""
+    import hail as hl
+    sc = hl.spark_context()
+    memory = parse_memory(sc.getConf().get('spark.executor.memory', '1g'))
+    # the driver is listed together with the executors
+    n_executors = max(1, sc._jsc.sc().getExecutorMemoryStatus().size() - 1)
+    return memory, n_executors, sc.defaultParallelism
+
+
+def plan_batches(blocks, memory_factor=4, waves=4):
+    """Split blocks into contiguous batches of similar cost.
+
+    ``blocks`` is a list of (n_rows, n_cols, n_partitions). A batch is
+    closed when its estimated entry size exceeds ``memory_factor`` times
+    the memory of all executors or its partitions exceed ``waves`` rounds
+    of tasks over all cores. Return a list of (start, end) slices."""
+    memory, n_executors, cores = cluster_resources()
+    max_bytes = memory_factor * memory * n_executors
+    max_partitions = waves * cores
+
+    batches = []
+    start, size, partitions = 0, 0, 0
+    for i, (n_rows, n_cols, n_partitions) in enumerate(blocks):
+        block_size = n_rows * n_cols * BYTES_PER_ENTRY
+        if i > start and (size + block_size > max_bytes or partitions + n_partitions > max_partitions):
+            batches.append((start, i))
+            start, size, partitions = i, 0, 0
+        size += block_size
+        partitions += n_partitions
+    if start < len(blocks):
+        batches.append((start, len(blocks)))
+    return batches
+
+
+def target_partitions(n_rows, n_cols, partition_bytes=128 * 2 ** 20):
+    """Number of partitions giving about ``partition_bytes`` of entries
+    each."""
+    rows_per_partition = max(1, partition_bytes // max(1, n_cols * BYTES_PER_ENTRY))
+    return max(1, ceil(n_rows / rows_per_partition))
+
+
+def rebalance(mt, n_rows, n_cols, partition_bytes=128 * 2 ** 20):
+    """Coalesce, or repartition, ``mt`` to about ``partition_bytes`` per
+    partition."""
+    n = target_partitions(n_rows, n_cols, partition_bytes)
+    if n < mt.n_partitions():
+        return mt.naive_coalesce(n)
+    elif n > 2 * mt.n_partitions():
+        return mt.repartition(n)
+    return mt
@@ -0,0 +1,36 @@
+import json
+import hashlib
+
+
+def fingerprint(*parts):
+    """Short stable digest of JSON serializable ``parts``."""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+class StageCache:
+    """Content addressed outputs of pipeline stages in a local folder.
+
+    The output of stage ``name`` for inputs with fingerprint ``key`` is
+    written to ``<name>-<key>.mt`` (or another ``suffix``, e.g. '.bm'); small
+    results of the stage are saved next to it in ``<name>-<key>.mt.json``
+    once the output is complete. An output is reused when both its
+    ``_SUCCESS`` and the JSON exist."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def lookup(self, name, key, suffix='.mt'):
+        """Return the output path and the saved info, None if missing."""
+        path = self.folder / f'{name}-{key}{suffix}'
+        info_path = self.folder / f'{name}-{key}{suffix}.json'
+        if (path / '_SUCCESS').exists() and info_path.exists():
+            with open(info_path) as f:
+                return path, json.load(f)
+        return path, None
+
+    def save(self, path, info):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(self.folder / f'{path.name}.json', 'w') as f:
+            json.dump(info, f)
+        return info
@@ -1,12 +1,60 @@
+import os
+import time
+import hashlib
+import threading
+import subprocess
+from collections import OrderedDict
 from pathlib import PosixPath, PurePath
 
-import dxpy
+from analysis.utils.storage import default_backend
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        """Drop the entries whose key matches ``predicate`` (all by default)."""
+        with self._lock:
+            for key in list(self._data):
+                if predicate is None or predicate(key):
+                    del self._data[key]
 
 
 class PathDx(PosixPath):
     DRV_DNAX = 'dnax://'
     DRV_LOCAL = 'file://'
 
+    # database name/id -> description, (database_id, folder) -> listing
+    _databases = TTLCache(maxsize=256, ttl=3600)
+    _listings = TTLCache(maxsize=4096, ttl=300)
+    # database API, see analysis.utils.storage
+    backend = default_backend()
+
     def __new__(cls, *args, database=None, database_id=None):
         if database is None and database_id is None:
             c = super().__new__(cls, *args)
@@ -16,21 +64,25 @@ class PathDx(PosixPath):
             if database is not None:
                 database_id = PathDx.find_database(database)['id']
             c = super().__new__(cls, '/', *args)
-            c._drv = f"{PathDx.DRV_DNAX}{database_id}"     
+            c._drv = f"{PathDx.DRV_DNAX}{database_id}"
         return c
 
+    @classmethod
+    def set_backend(cls, backend):
+        cls.backend = backend
+        cls.clear_cache()
+
+    @classmethod
+    def create_database(cls, name):
+        cls.backend.create_database(name)
+
     @classmethod
     def find_database(cls, db_ref=None):
-        databases_dx = dxpy.api.system_find_databases()
-        assert databases_dx['next'] is None
-        # TODO: handle 'next' request
-        databases_dx = databases_dx['results']
-        for db in databases_dx:
-            database_id = db['id']
-            database_desc = dxpy.api.database_describe(database_id)
-            database_name = database_desc['name']
-            if database_id == db_ref or database_name == db_ref:
-                db.update(database_desc)
+        db = cls._databases.get(db_ref)
+        if db is not None:
+            return db
+        for db in cls._iter_databases():
+            if db['id'] == db_ref or db['name'] == db_ref:
                 return db
         else:
             msg = f"Database doesn't exist. " \
@@ -38,31 +90,91 @@ class PathDx(PosixPath):
             f"IF NOT EXISTS {db_ref} LOCATION 'dnax://'\")"
             raise ValueError(msg)
 
+    @classmethod
+    def _iter_databases(cls):
+        """Stream described databases page by page, caching each of them
+        by id and by name."""
+        input_params = {'describe': True}
+        while True:
+            databases_dx = cls.backend.find_databases(input_params)
+            for db in databases_dx['results']:
+                database_desc = db.get('describe') or cls.backend.describe_database(db['id'])
+                db.update(database_desc)
+                cls._databases.set(db['id'], db)
+                cls._databases.set(db['name'], db)
+                yield db
+            if databases_dx.get('next') is None:
+                break
+            input_params['starting'] = databases_dx['next']
+
+    @classmethod
+    def clear_cache(cls):
+        cls._databases.invalidate()
+        cls._listings.invalidate()
+
+    @property
+    def database_id(self):
+        return self._drv[len(PathDx.DRV_DNAX):] if self._drv else None
+
+    @property
+    def folder(self):
+        return str(PathDx(*self.parts[1:])) if len(self.parts) > 1 else '/'
+
+    def invalidate(self):
+        """Forget cached listings of this path, its parents and children.
+        Call after writing to the path."""
+        if not self._drv:
+            return
+        folder = self.folder
+
+        def related(key):
+            database_id, cached = key
+            return database_id == self.database_id and (
+                cached == '/'
+                or folder == cached
+                or folder.startswith(cached + '/')
+                or cached.startswith(folder + '/')
+            )
+        PathDx._listings.invalidate(related)
+
     @property
     def rstr(self):
         database = None
         if self._drv:
-            p = str(self)
+            p = PathDx.backend.url(self)
         else:
             p =  f'{PathDx.DRV_LOCAL}{str(self.resolve())}'
         return p
 
-    def iterdir(self):
-        if self._drv:
-            database_id = self._drv[len(PathDx.DRV_DNAX):]
-            folder = str(PathDx(*self.parts[1:])) if len(self.parts) > 1 else '/'
-            files_response = dxpy.api.database_list_folder(
-                database_id,
-                input_params = {
-                    'folder': folder,
-                    'includeHidden': True,
-                }
-            )
-            files = [file_d['path'] for file_d in files_response['results']]
-            if not files_response['results']:
+    def _iter_folder(self):
+        """Stream folder listing results, following pagination. The full
+        listing is cached once it was read to the end."""
+        key = (self.database_id, self.folder)
+        results = PathDx._listings.get(key)
+        if results is not None:
+            yield from results
+            return
+
+        results = []
+        input_params = {
+            'folder': self.folder,
+            'includeHidden': True,
+        }
+        while True:
+            files_response = PathDx.backend.list_folder(self.database_id, input_params)
+            if not results and not files_response['results']:
                 raise Warning('Directory is empty OR path does not exist.')
+            results.extend(files_response['results'])
+            yield from files_response['results']
+            if files_response.get('next') is None:
+                break
+            input_params['starting'] = files_response['next']
+        PathDx._listings.set(key, results)
 
-            for result in files_response['results']:
+    def iterdir(self):
+        if self._drv:
+            database_id = self.database_id
+            for result in self._iter_folder():
                 file_path_split = result['path'].split(database_id)
                 file_path = file_path_split[-1]
                 if len(file_path_split) == 1:
@@ -76,3 +188,130 @@ class PathDx(PosixPath):
 
     def listdir(self):
         return list(self.iterdir())
+
+
+# empty BGZF block terminating every complete .vcf.gz
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# bytes read at a time while copying and checksumming staged files
+CHUNK_SIZE = 2 ** 22
+
+
+class Stager:
+    """Make input files, e.g. pVCF blocks under /mnt/project, readable by
+    Hail on all nodes.
+
+    In the 'direct' mode files are read from where they are, in the 'copy'
+    mode they are copied to ``folder`` (HDFS) first. Copies take at most
+    ``budget`` bytes in total, ``stage`` waits until enough of them were
+    released. Copies are checked against the MD5 of the source, taken
+    while it is sent to HDFS, and ``.gz`` files against the BGZF
+    end-of-file block. The 'auto' mode reads directly if the executors can read the
+    file (checked once with a tiny Spark job on ``sc``), else copies."""
+    MODES = ('auto', 'direct', 'copy')
+
+    def __init__(self, mode='auto', folder='/cluster/', budget=200 * 2 ** 30, sc=None):
+        if mode not in Stager.MODES:
+            raise ValueError(f'Unknown staging mode: {mode}')
+        self.mode = mode
+        self.folder = folder
+        self.budget = budget
+        self.sc = sc
+        self._used = 0
+        self._sizes = {}
+        self._cond = threading.Condition()
+
+    def executors_can_read(self, p):
+        if self.sc is None:
+            return False
+        path = str(p)
+        n = self.sc.defaultParallelism
+        try:
+            readable = self.sc.parallelize(range(n), n).map(
+                lambda _: os.access(path, os.R_OK)
+            ).collect()
+        except Exception:
+            return False
+        return all(readable)
+
+    def resolve_mode(self, p):
+        with self._cond:
+            if self.mode == 'auto':
+                self.mode = 'direct' if self.executors_can_read(p) else 'copy'
+                print(f'Staging mode: {self.mode}', flush=True)
+            return self.mode
+
+    def stage(self, p):
+        """Return the path of ``p`` to read with Hail."""
+        if self.resolve_mode(p) == 'direct':
+            return p
+
+        size = os.stat(p).st_size
+        with self._cond:
+            # a file larger than the budget is staged alone
+            self._cond.wait_for(lambda: self._used == 0 or self._used + size <= self.budget)
+            p_local = PathDx(self.folder) / p.name
+            self._used += size
+            self._sizes[p_local] = size
+        try:
+            print(f'Copying {p_local.rstr}...', flush=True)
+            digest = self.copy(p, p_local)
+            self.verify(p_local, size, digest)
+        except Exception:
+            self.release(p_local)
+            raise
+        return p_local
+
+    def copy(self, p, p_local):
+        """Copy ``p`` to HDFS with ``hdfs dfs -put``, return the MD5 of
+        the bytes sent."""
+        md5 = hashlib.md5()
+        put = subprocess.Popen(['hdfs', 'dfs', '-put', '-f', '-', p_local.rstr], stdin=subprocess.PIPE)
+        try:
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    put.stdin.write(chunk)
+        finally:
+            put.stdin.close()
+            returncode = put.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, put.args)
+        return md5.hexdigest()
+
+    def verify(self, p_local, size, digest):
+        copied = subprocess.run(
+            ['hdfs', 'dfs', '-stat', '%b', p_local.rstr],
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+        if int(copied) != size:
+            raise IOError(f'{p_local}: copied {copied} of {size} bytes')
+        md5 = hashlib.md5()
+        cat = subprocess.Popen(['hdfs', 'dfs', '-cat', p_local.rstr], stdout=subprocess.PIPE)
+        with cat.stdout:
+            for chunk in iter(lambda: cat.stdout.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+        if cat.wait():
+            raise subprocess.CalledProcessError(cat.returncode, cat.args)
+        if md5.hexdigest() != digest:
+            raise IOError(f'{p_local}: MD5 of the copy differs from the source')
+        if p_local.name.endswith('.gz'):
+            # -tail prints the last kilobyte
+            tail = subprocess.run(
+                ['hdfs', 'dfs', '-tail', p_local.rstr],
+                check=True, capture_output=True,
+            ).stdout
+            if not tail.endswith(BGZF_EOF):
+                raise IOError(f'{p_local}: BGZF end-of-file block is missing')
+
+    def release(self, p_local):
+        """Remove a copy made by ``stage``, nothing to do for direct reads."""
+        with self._cond:
+            size = self._sizes.pop(p_local, None)
+        if size is None:
+            return
+        try:
+            subprocess.run(['hdfs', 'dfs', '-rm', '-r', '-skipTrash', p_local.rstr], check=True)
+        finally:
+            with self._cond:
+                self._used -= size
+                self._cond.notify_all()
@@ -0,0 +1,381 @@
+import os
+import json
+import zlib
+import shutil
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+DIGITS = np.frombuffer(b'0123456789', dtype=np.uint8)
+
+
+class BlockGzipWriter:
+    """Binary writer compressing ``chunk_size`` chunks as independent gzip
+    members in a thread pool (zlib releases the GIL while compressing).
+    Concatenated members form a valid gzip file for gzip/zcat/pandas.
+
+    With ``offset`` the file is truncated to ``offset`` bytes, the end of
+    a previous ``flush``, and appended to."""
+
+    def __init__(self, path, n_threads=4, chunk_size=16 * 2 ** 20, level=6, offset=0):
+        self.n_threads = n_threads
+        self.chunk_size = chunk_size
+        self.level = level
+        if offset:
+            self._f = open(path, 'r+b')
+            self._f.truncate(offset)
+            self._f.seek(offset)
+        else:
+            self._f = open(path, 'wb')
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(n_threads)
+
+    def _compress(self, data):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(self._compress, data))
+        # keep a bounded number of chunks in memory
+        while len(self._pending) > 2 * self.n_threads:
+            self._f.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._submit(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def _drain(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._f.write(self._pending.popleft().result())
+
+    def flush(self):
+        """Write out everything written so far, return the file size."""
+        self._drain()
+        self._f.flush()
+        return self._f.tell()
+
+    def write_compressed(self, src):
+        """Copy already gzip compressed members from the ``src`` file."""
+        self._drain()
+        shutil.copyfileobj(src, self._f)
+
+    def close(self):
+        self._drain()
+        self._pool.shutdown()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def format_csv_rows(names, arr, n_zero=0, chunk_bytes=64 * 2 ** 20):
+    """Iterate through bytes of CSV lines ``name,v_1,...,v_m`` followed by
+    ``n_zero`` extra ``0`` columns for an integer slab with values 0-9.
+
+    Digits are looked up for the whole slab at once, only the row names are
+    joined in Python."""
+    n, m = arr.shape
+    if arr.size and (arr.min() < 0 or arr.max() > 9):
+        raise ValueError('Only single digit values can be formatted.')
+    row_len = 2 * (m + n_zero) + 1
+    step = max(1, chunk_bytes // row_len)
+    names = [name.encode() for name in names]
+    for start in range(0, n, step):
+        end = min(start + step, n)
+        body = np.empty((end - start, row_len), dtype=np.uint8)
+        body[:, 0:-1:2] = ord(',')
+        body[:, 1:2 * m:2] = DIGITS[arr[start:end]]
+        body[:, 2 * m + 1:-1:2] = ord('0')
+        body[:, -1] = ord('\n')
+        buf = body.tobytes()
+        rows = (buf[i * row_len:(i + 1) * row_len] for i in range(end - start))
+        yield b''.join(chain.from_iterable(zip(names[start:end], rows)))
+
+
+def iter_slabs(bm, slab_size=512 * 100, prefetch=1, first_row=0):
+    """Iterate through (start, int8 array) row slabs of a BlockMatrix from
+    ``first_row`` on. The next ``prefetch`` slabs are read in the background
+    while the current one is consumed."""
+    n_rows = bm.shape[0]
+
+    def read(start):
+        end = min(start + slab_size, n_rows)
+        return start, bm[start:end, :].to_numpy().astype(np.int8)
+
+    starts = iter(range(first_row, n_rows, slab_size))
+    with ThreadPoolExecutor(1) as pool:
+        futures = deque(pool.submit(read, start) for start in islice(starts, prefetch + 1))
+        while futures:
+            slab = futures.popleft().result()
+            for start in islice(starts, 1):
+                futures.append(pool.submit(read, start))
+            yield slab
+
+
+class ExportProgress:
+    """Progress of an export to ``path``, recorded in
+    ``<path>.progress.json``: the rows written and the file size after the
+    last complete slab, and whether the export is complete. A record of an
+    export of other data, with another ``key``, or without the output, is
+    ignored."""
+
+    def __init__(self, path, key):
+        self.output = path
+        self.path = f'{path}.progress.json'
+        self.key = key
+
+    def load(self):
+        """Return the recorded (rows, size, complete), (0, 0, False) if
+        there is none."""
+        if os.path.exists(self.path) and os.path.exists(self.output):
+            with open(self.path) as f:
+                record = json.load(f)
+            if record['key'] == self.key:
+                return record['rows'], record['size'], record['complete']
+        return 0, 0, False
+
+    def save(self, rows, size, complete=False):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'rows': rows, 'size': size, 'complete': complete}, f)
+        os.replace(tmp, self.path)
+
+    def complete(self):
+        rows, size, _ = self.load()
+        self.save(rows, size, complete=True)
+
+
+def write_csv_gz(path, samples, gene_names, zero_genes, slabs, n_threads=4, progress=None):
+    """Write samples x genes slabs as gzipped CSV, ``zero_genes`` columns
+    are appended as zeros.
+
+    With an ExportProgress the output is flushed and the progress saved
+    after every slab, and an interrupted export is continued: ``slabs``
+    then start at the recorded rows, see ``iter_slabs``."""
+    rows, size, _ = progress.load() if progress is not None else (0, 0, False)
+    with BlockGzipWriter(path, n_threads=n_threads, offset=size) as f:
+        if not size:
+            f.write(f"s,{','.join(chain(gene_names, zero_genes))}\n".encode())
+        for start, arr in slabs:
+            if start != rows:
+                raise ValueError(f'Slab of row {start} follows row {rows} of {path}')
+            names = samples[start:start + arr.shape[0]]
+            for chunk in format_csv_rows(names, arr, n_zero=len(zero_genes)):
+                f.write(chunk)
+            rows = start + arr.shape[0]
+            if progress is not None:
+                progress.save(rows, f.flush())
+
+
+def write_metadata(path, samples, gene_names, zero_genes, shape):
+    """Sidecar JSON with the row (sample) and column (gene) names."""
+    meta = {
+        'shape': list(shape),
+        'dtype': 'int8',
+        'samples': list(samples),
+        'genes': list(chain(gene_names, zero_genes)),
+        'zero_genes': list(zero_genes),
+    }
+    with open(f'{path}.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def write_npy(path, samples, gene_names, zero_genes, slabs):
+    """Write samples x genes as a memory-mappable int8 ``.npy`` array."""
+    shape = (len(samples), len(gene_names) + len(zero_genes))
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.int8, shape=shape)
+    for start, arr in slabs:
+        out[start:start + arr.shape[0], :arr.shape[1]] = arr
+    out[:, len(gene_names):] = 0
+    out.flush()
+    del out
+    write_metadata(path, samples, gene_names, zero_genes, shape)
+
+
+def write_zarr(path, samples, gene_names, zero_genes, slabs, chunks=(512 * 100, 1024)):
+    """Write samples x genes as a chunked int8 Zarr array."""
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('Zarr output needs the zarr package: pip install zarr')
+    shape = (len(samples), len(gene_names) + len(zero_genes))
+    out = zarr.open(path, mode='w', shape=shape, chunks=chunks, dtype='i1', fill_value=0)
+    for start, arr in slabs:
+        out[start:start + arr.shape[0], :arr.shape[1]] = arr
+    write_metadata(path, samples, gene_names, zero_genes, shape)
+
+
+def write_parquet(path, samples, gene_names, zero_genes, slabs):
+    """Write samples x genes as Parquet, one int8 column per gene and one
+    row group per slab."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet output needs the pyarrow package: pip install pyarrow')
+    columns = ['s'] + list(chain(gene_names, zero_genes))
+    schema = pa.schema([('s', pa.string())] + [(gene, pa.int8()) for gene in columns[1:]])
+    with pq.ParquetWriter(path, schema) as writer:
+        for start, arr in slabs:
+            n = arr.shape[0]
+            zeros = pa.array(np.zeros(n, dtype=np.int8))
+            arrays = [pa.array(samples[start:start + n])]
+            arrays += [pa.array(arr[:, j]) for j in range(arr.shape[1])]
+            arrays += [zeros] * len(zero_genes)
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    shape = (len(samples), len(columns) - 1)
+    write_metadata(path, samples, gene_names, zero_genes, shape)
+
+
+def collect_sparse(mt, field='value'):
+    """Collect the non-zero entries of a genes x samples MatrixTable as
+    samples x genes COO arrays (rows, cols, values)."""
+    mt = mt.add_row_index('_gene_idx').add_col_index('_sample_idx')
+    mt = mt.filter_entries(mt[field] != 0)
+    entries = mt.entries()
+    entries = entries.key_by().select(
+        i=entries._sample_idx, j=entries._gene_idx, v=entries[field]
+    )
+    triples = entries.collect()
+    rows = np.fromiter((t.i for t in triples), dtype=np.int64, count=len(triples))
+    cols = np.fromiter((t.j for t in triples), dtype=np.int32, count=len(triples))
+    values = np.fromiter((t.v for t in triples), dtype=np.int8, count=len(triples))
+    return rows, cols, values
+
+
+def sparse_slabs(coo, shape, slab_size=512 * 100):
+    """Iterate through dense (start, int8 array) row slabs of COO arrays."""
+    rows, cols, values = coo
+    order = np.argsort(rows, kind='stable')
+    rows, cols, values = rows[order], cols[order], values[order]
+    for start in range(0, shape[0], slab_size):
+        end = min(start + slab_size, shape[0])
+        lo, hi = np.searchsorted(rows, [start, end])
+        arr = np.zeros((end - start, shape[1]), dtype=np.int8)
+        arr[rows[lo:hi] - start, cols[lo:hi]] = values[lo:hi]
+        yield start, arr
+
+
+def write_npz(path, samples, gene_names, zero_genes, coo):
+    """Write samples x genes as a ``scipy.sparse`` CSR ``.npz`` matrix."""
+    try:
+        import scipy.sparse
+    except ImportError:
+        raise ImportError('npz output needs the scipy package: pip install scipy')
+    rows, cols, values = coo
+    shape = (len(samples), len(gene_names) + len(zero_genes))
+    matrix = scipy.sparse.coo_matrix((values, (rows, cols)), shape=shape).tocsr()
+    scipy.sparse.save_npz(path, matrix)
+    write_metadata(path, samples, gene_names, zero_genes, shape)
+
+
+def write_long_parquet(path, samples, gene_names, zero_genes, coo):
+    """Write the non-zero cells as long-format Parquet (s, gene, value)."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet output needs the pyarrow package: pip install pyarrow')
+    rows, cols, values = coo
+    table = pa.table({
+        's': pa.DictionaryArray.from_arrays(pa.array(rows.astype(np.int32)), pa.array(samples)),
+        'gene': pa.DictionaryArray.from_arrays(pa.array(cols), pa.array(gene_names)),
+        'value': pa.array(values),
+    })
+    pq.write_table(table, path)
+    shape = (len(samples), len(gene_names) + len(zero_genes))
+    write_metadata(path, samples, gene_names, zero_genes, shape)
+
+
+FORMATS = {
+    'csv': '.csv.gz',
+    'npy': '.npy',
+    'zarr': '.zarr',
+    'parquet': '.parquet',
+    'npz': '.npz',
+    'long-parquet': '.long.parquet',
+}
+SPARSE_FORMATS = ('npz', 'long-parquet')
+
+
+def export_matrix(output_format, prefix, samples, gene_names, zero_genes, slabs, n_threads=4,
+                  progress=None):
+    """Write samples x genes slabs to ``prefix`` + format suffix, return
+    the output path. The csv export continues from an ExportProgress,
+    see ``write_csv_gz``."""
+    if output_format not in FORMATS or output_format in SPARSE_FORMATS:
+        raise ValueError(f'Unknown dense output format: {output_format}')
+    path = f'{prefix}{FORMATS[output_format]}'
+    if output_format == 'csv':
+        write_csv_gz(
+            path, samples, gene_names, zero_genes, slabs, n_threads=n_threads, progress=progress
+        )
+    elif output_format == 'npy':
+        write_npy(path, samples, gene_names, zero_genes, slabs)
+    elif output_format == 'zarr':
+        write_zarr(path, samples, gene_names, zero_genes, slabs)
+    elif output_format == 'parquet':
+        write_parquet(path, samples, gene_names, zero_genes, slabs)
+    return path
+
+
+def export_sparse(output_format, prefix, samples, gene_names, zero_genes, coo, n_threads=4):
+    """Write samples x genes COO arrays to ``prefix`` + format suffix,
+    dense formats are derived from them slab by slab. Return the output
+    path."""
+    if output_format == 'npz':
+        path = f'{prefix}{FORMATS[output_format]}'
+        write_npz(path, samples, gene_names, zero_genes, coo)
+    elif output_format == 'long-parquet':
+        path = f'{prefix}{FORMATS[output_format]}'
+        write_long_parquet(path, samples, gene_names, zero_genes, coo)
+    else:
+        slabs = sparse_slabs(coo, (len(samples), len(gene_names)))
+        path = export_matrix(
+            output_format, prefix, samples, gene_names, zero_genes, slabs,
+            n_threads=n_threads
+        )
+    return path
+
+
+def export_gene_major(mt, path, shards_path, samples, zero_genes, field='value', n_threads=4):
+    """Export a genes x samples MatrixTable as gzipped CSV with one line
+    ``gene,v_1,...,v_n`` per gene, i.e. transposed to the samples x genes
+    tables of ``export_matrix``.
+
+    The export of the entries is the only Spark job: every partition
+    formats its localized entries and writes a bgzipped shard to the
+    ``shards_path`` directory. The column header ``samples`` and the
+    all-zero lines of ``zero_genes`` are given by the caller, the shards
+    are copied after the header without decompressing them."""
+    import hail as hl
+    ht = mt.select_entries(field).localize_entries('_entries')
+    ht = ht.key_by()
+    ht = ht.select(line=hl.delimit(
+        hl.array([ht.gene_name]).extend(ht._entries.map(lambda e: hl.str(e[field]))),
+        ','
+    ))
+    ht.export(shards_path.rstr, header=False, parallel='separate_header')
+
+    shards = sorted(p for p in os.listdir(shards_path) if p.startswith('part-'))
+    zeros = (',0' * len(samples)).encode() + b'\n'
+    with BlockGzipWriter(path, n_threads=n_threads) as f:
+        f.write(f"gene_name,{','.join(samples)}\n".encode())
+        for shard in shards:
+            with open(shards_path / shard, 'rb') as src:
+                f.write_compressed(src)
+        for gene in zero_genes:
+            f.write(gene.encode() + zeros)
+    return path
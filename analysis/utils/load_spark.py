@@ -1,39 +1,56 @@
 import os
+import json
 import random
+import shutil
 from itertools import count
-import hail as hl
 from uuid import uuid4
 import platform
-from pyspark.sql import SparkSession
+
+from analysis.utils.batching import parse_memory
 
 
 WD = None
 SC = None
 RESOURCES_PATH = None
 
-if 'aws' in platform.release():
-    builder = (
-        SparkSession
-        .builder
-        .config('spark.driver.memory', '60G')
-        .config('spark.executor.memory', '60G')
-        .config('spark.ui.showConsoleProgress', 'false')
-        .enableHiveSupport()
-    )
-    SC = builder.getOrCreate()
-
-    hl_init_kwargs = {
-        'sc': SC.sparkContext,
-        'default_reference': 'GRCh38'
-    }
-elif '.cyf.' in platform.release():
-    master = None
-    spark_conf = {
-        'spark.driver.memory': '40G',
-        'spark.executor.memory': '80G',
-        'spark.rpc.message.maxSize': '256',
-    }
+# Workload profiles, as fractions of the node's memory. Annotation is VEP
+# bound: few big partitions and VEP/LOFTEE processes which need memory
+# outside of the JVM. The gene aggregation is shuffle heavy. The export
+# collects block matrix slabs on the driver.
+PROFILES = {
+    'annotate': {
+        'executor_memory': 0.35, 'memory_overhead': 0.35, 'driver_memory': 0.25,
+        'partitions_per_core': 1, 'kryo': False, 'off_heap': 0.0,
+    },
+    'aggregate': {
+        'executor_memory': 0.6, 'memory_overhead': 0.1, 'driver_memory': 0.3,
+        'partitions_per_core': 4, 'kryo': True, 'off_heap': 0.1,
+    },
+    'export': {
+        'executor_memory': 0.45, 'memory_overhead': 0.1, 'driver_memory': 0.5,
+        'partitions_per_core': 2, 'kryo': True, 'off_heap': 0.0,
+    },
+}
+DEFAULT_PROFILE = 'aggregate'
+CONFIG_PATH = os.path.expanduser('~/.config/loftee_annot/spark.json')
+
+
+def detect_platform():
+    """'aws' (DNAnexus), 'cyf' (Cyfronet clusters) or 'local'; the
+    ANALYSIS_PLATFORM environment variable takes precedence."""
+    if os.environ.get('ANALYSIS_PLATFORM'):
+        return os.environ['ANALYSIS_PLATFORM']
+    if 'aws' in platform.release():
+        return 'aws'
+    if '.cyf.' in platform.release():
+        return 'cyf'
+    return 'local'
 
+
+PLATFORM = detect_platform()
+
+if PLATFORM == 'cyf':
+    master = None
     localfs_path = os.environ.get('SCRATCH_LOCAL') + '/'
     scratch_path = os.environ.get('SCRATCH') + '/'
     hail_log_uuid = str(uuid4())
@@ -51,20 +68,149 @@ elif '.cyf.' in platform.release():
         spark_master_port = os.environ.get('SPARK_MASTER_PORT')
         master = f'spark://{spark_master_host}:{spark_master_port}'
 
-    hl_init_kwargs = {
-        'master': master,
-        'tmp_dir': os.path.join(scratch_path, 'hail-tmpdir'),
+
+def node_resources():
+    """(cores, memory in bytes) available on this node, within the SLURM
+    allocation if there is one, or as set by $ANALYSIS_CORES and
+    $ANALYSIS_MEMORY. Executors are assumed to run on nodes of the same
+    size."""
+    cores = len(os.sched_getaffinity(0))
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    if os.environ.get('SLURM_MEM_PER_NODE'):
+        memory = min(memory, int(os.environ['SLURM_MEM_PER_NODE']) * 2 ** 20)
+    if os.environ.get('ANALYSIS_CORES'):
+        cores = int(os.environ['ANALYSIS_CORES'])
+    if os.environ.get('ANALYSIS_MEMORY'):
+        memory = parse_memory(os.environ['ANALYSIS_MEMORY'])
+    return cores, memory
+
+
+def local_tmpdir():
+    """Hail's local temporary folder on the local disk with the most
+    free space."""
+    candidates = [os.environ.get('SCRATCH_LOCAL'), os.environ.get('TMPDIR'), '/tmp']
+    candidates = [path for path in candidates if path and os.path.isdir(path)]
+    best = max(candidates, key=lambda path: shutil.disk_usage(path).free)
+    return os.path.join(best, 'hail-local-tmpdir')
+
+
+def gigabytes(n_bytes):
+    return f'{max(1, int(n_bytes / 2 ** 30))}G'
+
+
+def spark_conf(profile, cores, memory, n_nodes=None):
+    """Spark settings of a workload profile for nodes with ``cores`` and
+    ``memory``."""
+    p = PROFILES[profile]
+    conf = {
+        'spark.ui.showConsoleProgress': 'false',
+        'spark.driver.memory': gigabytes(memory * p['driver_memory']),
+        'spark.rpc.message.maxSize': '256',
+    }
+    if PLATFORM == 'local':
+        # the driver runs the tasks too, leave a quarter to the OS and VEP
+        conf['spark.driver.memory'] = gigabytes(
+            memory * min(0.75 - p['off_heap'], p['driver_memory'] + p['executor_memory'])
+        )
+    else:
+        conf.update({
+            'spark.executor.cores': str(cores),
+            'spark.executor.memory': gigabytes(memory * p['executor_memory']),
+            'spark.executor.memoryOverhead': gigabytes(memory * p['memory_overhead']),
+        })
+    if n_nodes:
+        partitions = str(p['partitions_per_core'] * cores * n_nodes)
+        conf['spark.default.parallelism'] = partitions
+        conf['spark.sql.shuffle.partitions'] = partitions
+    if p['kryo']:
+        conf['spark.serializer'] = 'org.apache.spark.serializer.KryoSerializer'
+        conf['spark.kryoserializer.buffer.max'] = '1g'
+    if p['off_heap']:
+        conf['spark.memory.offHeap.enabled'] = 'true'
+        conf['spark.memory.offHeap.size'] = gigabytes(memory * p['off_heap'])
+    if profile == 'export':
+        conf['spark.driver.maxResultSize'] = gigabytes(memory * p['driver_memory'] / 2)
+    return conf
+
+
+def overrides(profile):
+    """Settings of ``profile`` from the config file ($ANALYSIS_SPARK_CONFIG
+    or ~/.config/loftee_annot/spark.json, {"default": {...}, "<profile>":
+    {...}}) and from $ANALYSIS_SPARK_CONF ("key=value,key=value"). Keys
+    not starting with 'spark.' are passed to hl.init, e.g. local_tmpdir."""
+    settings = {}
+    path = os.environ.get('ANALYSIS_SPARK_CONFIG', CONFIG_PATH)
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+        settings.update(config.get('default', {}))
+        settings.update(config.get(profile, {}))
+    for item in filter(None, os.environ.get('ANALYSIS_SPARK_CONF', '').split(',')):
+        key, value = item.split('=', 1)
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+def init_kwargs(profile):
+    """hl.init arguments of the platform for a workload profile."""
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile {profile}, use one of {", ".join(PROFILES)}')
+    cores, memory = node_resources()
+    n_nodes = os.environ.get('ANALYSIS_NODES') or os.environ.get('SLURM_NNODES')
+    conf = spark_conf(profile, cores, memory, int(n_nodes) if n_nodes else None)
+    kwargs = {
         'default_reference': 'GRCh38',
-        'spark_conf': spark_conf,
-        'log': os.path.join(scratch_path, f'slurm-log/hail-{hail_log_uuid}.log'),
-        'local_tmpdir': os.path.join(localfs_path, 'hail-local-tmpdir')
+        'local_tmpdir': local_tmpdir(),
     }
-else:
-    raise ValueError(f'Platform release {platform.release()} unknown.')
+    if PLATFORM == 'local':
+        kwargs['master'] = f'local[{cores}]'
+    elif PLATFORM == 'cyf':
+        kwargs.update({
+            'master': master,
+            'tmp_dir': os.path.join(scratch_path, 'hail-tmpdir'),
+            'log': os.path.join(scratch_path, f'slurm-log/hail-{hail_log_uuid}.log'),
+        })
+    elif PLATFORM != 'aws':
+        raise ValueError(f'Platform {PLATFORM} unknown.')
+    for key, value in overrides(profile).items():
+        if key.startswith('spark.'):
+            conf[key] = value
+        else:
+            kwargs[key] = value
+    kwargs['spark_conf'] = conf
+    return kwargs
 
 
-def hl_init(**kwargs):
+def spark_session(profile=None):
+    """The Spark session with Hive support of the 'aws' platform, started
+    once with the settings of a workload profile ($ANALYSIS_PROFILE or
+    'aggregate' by default). A session started before would keep its own
+    settings, so start it with this before anything else uses Spark."""
+    global SC
+    if SC is None:
+        from pyspark.sql import SparkSession
+        profile = profile or os.environ.get('ANALYSIS_PROFILE', DEFAULT_PROFILE)
+        conf = init_kwargs(profile)['spark_conf']
+        print(f'Spark profile {profile} on {PLATFORM}: {conf}', flush=True)
+        builder = SparkSession.builder.enableHiveSupport()
+        for key, value in conf.items():
+            builder = builder.config(key, value)
+        SC = builder.getOrCreate()
+    return SC
+
+
+def hl_init(profile=None, **kwargs):
+    """Start Spark and Hail with the settings of a workload profile
+    ($ANALYSIS_PROFILE or 'aggregate' by default)."""
+    import hail as hl
+    profile = profile or os.environ.get('ANALYSIS_PROFILE', DEFAULT_PROFILE)
+    hl_init_kwargs = init_kwargs(profile)
     hl_init_kwargs.update(kwargs)
+    if PLATFORM == 'aws':
+        del hl_init_kwargs['spark_conf']
+        hl_init_kwargs['sc'] = spark_session(profile).sparkContext
+    else:
+        print(f'Spark profile {profile} on {PLATFORM}: {hl_init_kwargs["spark_conf"]}', flush=True)
     hl.init(**hl_init_kwargs)
 
 
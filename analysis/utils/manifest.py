@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def file_fingerprint(p):
+    """Cheap input checksum of a file: sha1 of its name, size and mtime."""
+    st = os.stat(p)
+    key = f'{p.name}:{st.st_size}:{int(st.st_mtime)}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class BlockManifest:
+    """Block id -> status record (status, output path, row/column counts,
+    input checksum, timings) kept in a single JSON document.
+
+    The document is read once with ``load`` and rewritten as a whole after
+    every ``update``, so finding out which blocks are done costs one read
+    instead of listing the database. It can live on a local path or in
+    a DNAX database.
+
+    With ``cache_path`` a local copy is kept up to date, ``load_cached``
+    reads it without Hail, e.g. to plan a run."""
+    FILE_NAME = '_manifest.json'
+
+    def __init__(self, path, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the manifest, return False if it doesn't exist yet."""
+        import hail as hl
+        if not hl.hadoop_exists(self.path.rstr):
+            return False
+        with hl.hadoop_open(self.path.rstr, 'r') as f:
+            self.blocks = json.load(f)
+        self._save_cache(json.dumps(self.blocks, indent=1, sort_keys=True))
+        return True
+
+    def load_cached(self):
+        """Read the local copy, return False if there is none."""
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return False
+        with open(self.cache_path) as f:
+            self.blocks = json.load(f)
+        return True
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        import hail as hl
+        data = json.dumps(self.blocks, indent=1, sort_keys=True)
+        if self.path._drv:
+            # single object upload, visible only once it is complete
+            with hl.hadoop_open(self.path.rstr, 'w') as f:
+                f.write(data)
+            self.path.invalidate()
+        else:
+            tmp = f'{self.path}.tmp-{os.getpid()}-{threading.get_ident()}'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        self._save_cache(data)
+
+    def _save_cache(self, data):
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp = f'{self.cache_path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.cache_path)
+
+    def get(self, block_id):
+        return self.blocks.get(block_id, {})
+
+    def is_done(self, block_id):
+        return self.get(block_id).get('status') == 'done'
+
+    def update(self, block_id, **record):
+        with self._lock:
+            self.blocks.setdefault(block_id, {}).update(record)
+            self._save()
+
+    def update_many(self, records):
+        """Update the records of several blocks in a single write."""
+        with self._lock:
+            for block_id, record in records.items():
+                self.blocks.setdefault(block_id, {}).update(record)
+            self._save()
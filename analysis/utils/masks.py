@@ -0,0 +1,134 @@
+import os
+import json
+from functools import reduce
+
+
+ENCODINGS = ('dosage', 'carrier', 'hom', 'count')
+
+
+class Mask:
+    """Which variants of a gene count for a sample and how they are encoded.
+
+    A variant qualifies if the LOFTEE confidence of its transcript is in
+    ``lof`` ('HC', 'LC') or one of its consequence terms is in
+    ``consequences`` (e.g. 'missense_variant'), and, with ``max_maf``,
+    if its minor allele frequency is at most ``max_maf``.
+
+    Encodings of the qualifying genotypes of a sample in a gene:
+    'dosage' 2 for a homozygote, else the number of heterozygotes capped
+    at 2; 'carrier' 1 for any; 'hom' 1 for a homozygote; 'count' the
+    number of alternate alleles, capped at 9."""
+
+    def __init__(self, name, lof=('HC',), consequences=(), max_maf=None, encoding='dosage'):
+        if not lof and not consequences:
+            raise ValueError(f'Mask {name} needs lof or consequences.')
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding {encoding}, use one of {", ".join(ENCODINGS)}')
+        self.name = name
+        self.lof = tuple(lof or ())
+        self.consequences = tuple(consequences or ())
+        self.max_maf = max_maf
+        self.encoding = encoding
+
+    def spec(self):
+        return {
+            'name': self.name, 'lof': list(self.lof), 'consequences': list(self.consequences),
+            'max_maf': self.max_maf, 'encoding': self.encoding,
+        }
+
+    def __repr__(self):
+        return f'Mask({self.spec()})'
+
+    def qualifies(self, tc):
+        """Whether the transcript consequence ``tc`` qualifies, MAF aside."""
+        import hail as hl
+        conditions = []
+        if self.lof:
+            conditions.append(hl.literal(set(self.lof)).contains(tc.lof))
+        if self.consequences:
+            if 'consequence_terms' not in tc.dtype:
+                raise ValueError(
+                    f'Mask {self.name} needs consequence_terms, which slim blocks '
+                    'annotated before they were kept lack.'
+                )
+            terms = hl.literal(set(self.consequences))
+            conditions.append(tc.consequence_terms.any(lambda term: terms.contains(term)))
+        return hl.coalesce(reduce(lambda x, y: x | y, conditions), False)
+
+    def encode(self, n_het, n_hom):
+        import hail as hl
+        if self.encoding == 'dosage':
+            return hl.if_else(n_hom > 0, 2, hl.min(n_het, 2))
+        if self.encoding == 'carrier':
+            return hl.int(n_het + n_hom > 0)
+        if self.encoding == 'hom':
+            return hl.int(n_hom > 0)
+        return hl.min(n_het + 2 * n_hom, 9)
+
+
+MASKS = {
+    'hc_lof': Mask('hc_lof'),
+    'any_lof': Mask('any_lof', lof=('HC', 'LC')),
+    'hc_lof_carrier': Mask('hc_lof_carrier', encoding='carrier'),
+    'hc_lof_missense': Mask('hc_lof_missense', consequences=('missense_variant',)),
+    'hc_lof_rare': Mask('hc_lof_rare', max_maf=0.01),
+}
+DEFAULT_MASKS = ('hc_lof',)
+
+
+def parse_masks(value):
+    """Masks of a comma separated list of names in MASKS, or of a JSON
+    file with a list of Mask arguments, e.g.
+    ``[{"name": "lof_mis", "lof": ["HC"], "consequences": ["missense_variant"],
+    "max_maf": 0.01, "encoding": "carrier"}]``."""
+    if os.path.isfile(value):
+        with open(value) as f:
+            masks = [Mask(**spec) for spec in json.load(f)]
+    else:
+        unknown = [name for name in value.split(',') if name not in MASKS]
+        if unknown:
+            raise ValueError(f'Unknown masks {", ".join(unknown)}, use one of {", ".join(MASKS)}')
+        masks = [MASKS[name] for name in value.split(',')]
+    names = [mask.name for mask in masks]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Mask names are not unique: {", ".join(names)}')
+    return masks
+
+
+def prefilter(masks, tc):
+    """Whether to keep the transcript consequence ``tc`` before the QC: it
+    has a LOFTEE annotation, HC or LC, as in the single mask tables, or it
+    qualifies for any mask. Genes with only LC variants thus stay in the
+    tables, with zeros, whichever the masks."""
+    import hail as hl
+    return reduce(lambda x, y: x | y, (mask.qualifies(tc) for mask in masks), hl.is_defined(tc.lof))
+
+
+def aggregate_masks(mt, masks, tc_field='transcript_consequences'):
+    """Genes x samples table with one entry field per mask, all masks
+    aggregated by a single ``group_rows_by`` of ``mt``.
+
+    ``mt`` has one transcript consequence per row in ``mt.vep[tc_field]``
+    and a ``gene_name`` row field."""
+    import hail as hl
+    if any(mask.max_maf is not None for mask in masks):
+        af = hl.agg.mean(mt.GT.n_alt_alleles()) / 2
+        mt = mt.annotate_rows(_maf=hl.min(af, 1 - af))
+    tc = mt.vep[tc_field]
+    row_masks = {}
+    for mask in masks:
+        qualifies = mask.qualifies(tc)
+        if mask.max_maf is not None:
+            qualifies = qualifies & (mt._maf <= mask.max_maf)
+        row_masks[mask.name] = qualifies
+    mt = mt.annotate_rows(_masks=hl.struct(**row_masks))
+    aggregations = {}
+    for mask in masks:
+        qualifies = mt._masks[mask.name]
+        aggregations[f'{mask.name}_het'] = hl.agg.count_where(qualifies & mt.GT.is_het())
+        aggregations[f'{mask.name}_hom'] = hl.agg.count_where(qualifies & mt.GT.is_hom_var())
+    result = mt.group_rows_by(mt.gene_name).aggregate_entries(**aggregations).result()
+    return result.select_entries(**{
+        mask.name: mask.encode(result[f'{mask.name}_het'], result[f'{mask.name}_hom'])
+        for mask in masks
+    })
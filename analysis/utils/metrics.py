@@ -0,0 +1,107 @@
+"""JSON lines metrics of the pipeline stages.
+
+Every finished stage appends one line to the metrics file of the run:
+run, stage, start, seconds, status, driver memory and the fields given
+by the stage (block, chrom, rows, partitions, bytes, ...). Nothing is
+written until ``metrics.start`` is called. See analysis/cmd/metrics_summary.py.
+"""
+import os
+import json
+import time
+import resource
+import threading
+from datetime import datetime
+
+
+class Span:
+    """One timed stage; ``end`` it, or use it as a context manager."""
+
+    def __init__(self, log, stage, fields):
+        self.log = log
+        self.stage = stage
+        self.fields = fields
+        self.started = datetime.now()
+        self._t0 = time.perf_counter()
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def end(self, status='ok', **fields):
+        self.fields.update(fields)
+        self.log.write({
+            'run': self.log.run,
+            'stage': self.stage,
+            'start': self.started.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self._t0, 3),
+            'status': status,
+            **self.log.driver_memory(),
+            **self.fields,
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.end()
+        else:
+            self.end('error', error=repr(exc))
+        return False
+
+
+class MetricsLog:
+    def __init__(self):
+        self.path = None
+        self.run = None
+        self.jvm = None
+        self._lock = threading.Lock()
+
+    def start(self, path, run=None, jvm=None):
+        """Write the metrics to ``path``; ``jvm`` (the py4j gateway of the
+        Spark driver) adds the used driver heap to every record."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.run = run or os.path.splitext(os.path.basename(path))[0]
+        self.jvm = jvm
+
+    def driver_memory(self):
+        # peak resident memory of the python driver, in kB on Linux
+        memory = {'driver_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        if self.jvm is not None:
+            try:
+                runtime = self.jvm.java.lang.Runtime.getRuntime()
+                memory['driver_heap'] = runtime.totalMemory() - runtime.freeMemory()
+            except Exception:
+                pass
+        return memory
+
+    def write(self, record):
+        if self.path is None:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def span(self, stage, **fields):
+        return Span(self, stage, fields)
+
+
+metrics = MetricsLog()
+
+
+def read_metrics(paths):
+    """Records of the metrics files in ``paths`` (files or folders)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith('.jsonl')
+            ))
+        else:
+            files.append(path)
+    records = []
+    for path in files:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import gzip
+import struct
+from collections import namedtuple
+
+from analysis.utils.manifest import BlockManifest
+
+
+TABIX_WINDOW = 2 ** 14
+# bin of the tabix metadata: file offsets and the number of records
+TABIX_PSEUDO_BIN = 37450
+# first bin of each level of the binning scheme, level 5 bins are 16 kb
+TABIX_LEVEL_OFFSETS = (0, 1, 9, 73, 585, 4681)
+
+# 1-based, both ends included
+Region = namedtuple('Region', 'contig start end')
+
+
+def bin_start(bin_id):
+    """0-based start of a tabix bin."""
+    level = max(i for i, first in enumerate(TABIX_LEVEL_OFFSETS) if bin_id >= first)
+    return (bin_id - TABIX_LEVEL_OFFSETS[level]) << (29 - 3 * level)
+
+
+def read_tabix(path):
+    """Contig -> (start, end, number of records) of a tabix index; start
+    and end are rounded to the 16 kb windows of its bins and linear
+    index."""
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'TBI\x01':
+        raise ValueError(f'{path} is not a tabix index')
+    n_ref, *_, l_nm = struct.unpack_from('<8i', data, 4)
+    offset = 36
+    names = data[offset:offset + l_nm].split(b'\0')[:n_ref]
+    offset += l_nm
+    ranges = {}
+    for name in names:
+        n_records = None
+        start = None
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_id == TABIX_PSEUDO_BIN:
+                n_records = struct.unpack_from('<4Q', data, offset)[2]
+            elif n_chunk:
+                # htslib fills the linear index windows before the first
+                # record with its offset, the lowest bin tells the start
+                start = bin_start(bin_id) if start is None else min(start, bin_start(bin_id))
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        ranges[name.decode()] = ((start or 0) + 1, n_intv * TABIX_WINDOW, n_records)
+    return ranges
+
+
+def normalize_contig(contig):
+    return contig if contig.startswith('chr') else f'chr{contig}'
+
+
+def read_bed(path):
+    """Regions of a BED file (0-based, end excluded)."""
+    regions = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            contig, start, end = line.split('\t')[:3]
+            regions.append(Region(normalize_contig(contig), int(start) + 1, int(end)))
+    return regions
+
+
+def to_intervals(regions, reference_genome='GRCh38'):
+    """Hail locus intervals of ``regions``, for hl.filter_intervals."""
+    import hail as hl
+    lengths = hl.get_reference(reference_genome).lengths
+    return [
+        hl.Interval(
+            hl.Locus(r.contig, max(1, r.start), reference_genome),
+            hl.Locus(r.contig, min(r.end, lengths[r.contig]), reference_genome),
+            includes_end=True,
+        )
+        for r in regions
+    ]
+
+
+class BlockIndex(BlockManifest):
+    """Block id -> genomic range of the block (contig, start, end,
+    n_variants and the source of the record: 'tbi' for the tabix index of
+    the pVCF block, 'mt' for the metadata of the written block).
+
+    Once scanned, a record also has the range of every gene of the
+    annotated block in ``genes``, to select blocks by gene name."""
+    FILE_NAME = '_block_index.json'
+
+    def add_vcf(self, block_id, vcf_path):
+        """Index a block from the tabix index next to ``vcf_path``, return
+        False if there is none."""
+        tbi_path = f'{vcf_path}.tbi'
+        if not os.path.exists(tbi_path):
+            return False
+        # a pVCF block has one contig
+        contig, (start, end, n_records) = next(iter(read_tabix(tbi_path).items()))
+        self.blocks[block_id] = {
+            'contig': contig, 'start': start, 'end': end, 'n_variants': n_records, 'source': 'tbi',
+        }
+        return True
+
+    def add_mt(self, block_id, mt_path, n_rows=None):
+        """Index a written block from the partition bounds in its
+        metadata, or by scanning its loci if they can't be read."""
+        import hail as hl
+        try:
+            with hl.hadoop_open(f'{mt_path}/rows/rows/metadata.json.gz', 'r') as f:
+                bounds = json.load(f)['_jRangeBounds']
+            start, end = bounds[0]['start']['locus'], bounds[-1]['end']['locus']
+            contig, start, end = start['contig'], start['position'], end['position']
+        except (KeyError, IndexError, ValueError, OSError):
+            ht = hl.read_matrix_table(mt_path).rows()
+            contig, start, end = ht.aggregate((
+                hl.agg.take(ht.locus.contig, 1)[0],
+                hl.agg.min(ht.locus.position),
+                hl.agg.max(ht.locus.position),
+            ))
+        self.blocks[block_id] = {
+            'contig': contig, 'start': start, 'end': end, 'n_variants': n_rows, 'source': 'mt',
+        }
+
+    def add_genes(self, block_id, ht):
+        """Record the gene ranges of the rows table ``ht`` of an annotated
+        block, genes named as in the LoF tables."""
+        import hail as hl
+        genes = ht.aggregate(hl.agg.explode(
+            lambda tc: hl.agg.group_by(
+                hl.coalesce(tc.gene_symbol, tc.gene_id),
+                hl.struct(start=hl.agg.min(ht.locus.position), end=hl.agg.max(ht.locus.position)),
+            ),
+            ht.vep.transcript_consequences,
+        ))
+        self.blocks[block_id]['genes'] = {
+            gene: [r.start, r.end] for gene, r in genes.items() if gene is not None
+        }
+
+    def block_region(self, block_id):
+        record = self.blocks[block_id]
+        return Region(record['contig'], record['start'], record['end'])
+
+    def gene_regions(self, genes):
+        """Regions of ``genes`` in the scanned blocks, and the genes which
+        weren't found."""
+        regions = []
+        found = set()
+        for record in self.blocks.values():
+            for gene in genes:
+                if gene in record.get('genes', {}):
+                    start, end = record['genes'][gene]
+                    regions.append(Region(record['contig'], start, end))
+                    found.add(gene)
+        return regions, [gene for gene in genes if gene not in found]
+
+    def overlapping(self, regions):
+        """Ids of the blocks overlapping any of ``regions``."""
+        return sorted(
+            block_id for block_id, record in self.blocks.items()
+            if any(
+                r.contig == record['contig'] and r.start <= record['end'] and record['start'] <= r.end
+                for r in regions
+            )
+        )
+
+    def select(self, items):
+        """Regions and ids of the blocks of a selection: ``chr1:1000-2000``
+        intervals, BED files, block ids and gene names. Raise ValueError
+        for genes not found in the scanned blocks."""
+        regions = []
+        genes = []
+        for item in items:
+            m = re.fullmatch(r'(\w+):(\d+)-(\d+)', item)
+            if os.path.isfile(item):
+                regions += read_bed(item)
+            elif m:
+                regions.append(Region(normalize_contig(m.group(1)), int(m.group(2)), int(m.group(3))))
+            elif item in self.blocks or f'{item}.mt' in self.blocks:
+                block_id = item if item in self.blocks else f'{item}.mt'
+                regions.append(self.block_region(block_id))
+            else:
+                genes.append(item)
+        if genes:
+            gene_regions, missing = self.gene_regions(genes)
+            if missing:
+                raise ValueError(f'Unknown regions or genes: {", ".join(missing)}')
+            regions += gene_regions
+        return regions, self.overlapping(regions)
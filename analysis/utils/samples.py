@@ -0,0 +1,99 @@
+import hashlib
+import threading
+
+
+def samples_digest(samples):
+    return hashlib.sha1('\n'.join(samples).encode()).hexdigest()
+
+
+class SampleIndex:
+    """Column keys (sample ids, in order) of annotated blocks.
+
+    Each block's manifest record stores the digest of its sample list.
+    The list itself is saved once per distinct digest as
+    ``samples-<digest>.txt`` in ``folder``. Blocks with the same digest have
+    the same columns in the same order, so they can be unioned without
+    collecting their columns."""
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.manifest = manifest
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return self.folder / f'samples-{digest}.txt'
+
+    def record(self, block_id, mt_path):
+        """Collect the samples of a block once and store their digest."""
+        import hail as hl
+        samples = hl.read_matrix_table(mt_path.rstr).s.collect()
+        digest = samples_digest(samples)
+        with self._lock:
+            if digest not in self._samples:
+                path = self._path(digest)
+                if not hl.hadoop_exists(path.rstr):
+                    with hl.hadoop_open(path.rstr, 'w') as f:
+                        f.write('\n'.join(samples))
+                    path.invalidate()
+                self._samples[digest] = samples
+        self.manifest.update(block_id, samples=digest)
+        return digest
+
+    def digest(self, block_id, mt_path):
+        digest = self.manifest.get(block_id).get('samples')
+        if digest is None:
+            digest = self.record(block_id, mt_path)
+        return digest
+
+    def samples(self, digest):
+        import hail as hl
+        with self._lock:
+            if digest not in self._samples:
+                with hl.hadoop_open(self._path(digest).rstr, 'r') as f:
+                    self._samples[digest] = f.read().split('\n')
+            return self._samples[digest]
+
+    def _order(self, digests):
+        """Samples common to the lists of ``digests``, in the order of the
+        first one."""
+        lists = {d: self.samples(d) for d in set(digests)}
+        common = set.intersection(*(set(pats) for pats in lists.values()))
+        return [s for s in lists[digests[0]] if s in common]
+
+    def columns(self, block_ids, eids=None):
+        """Column keys of the recorded blocks ``block_ids`` after
+        ``harmonize``, from the sample lists instead of the blocks."""
+        order = self._order([self.manifest.get(b)['samples'] for b in block_ids])
+        if eids:
+            eids = set(eids)
+            order = [s for s in order if s in eids]
+        return order
+
+    def harmonize(self, mts, eids=None):
+        """Return the MatrixTables of ``mts`` (dict block id -> (path, mt))
+        with identical columns, restricted to ``eids`` if given.
+
+        Columns are only reordered when the blocks don't share the same
+        sample list; ``eids`` are applied as a keyed semi-join."""
+        digests = {b: self.digest(b, path) for b, (path, mt) in mts.items()}
+        out = {b: mt for b, (path, mt) in mts.items()}
+        if len(set(digests.values())) > 1:
+            print('....harmonizing samples', flush=True)
+            order = self._order(list(digests.values()))
+            for b, d in digests.items():
+                if self.samples(d) != order:
+                    pos = {s: i for i, s in enumerate(self.samples(d))}
+                    out[b] = out[b].choose_cols([pos[s] for s in order])
+        if eids:
+            out = {b: restrict_samples(mt, eids) for b, mt in out.items()}
+        return out
+
+
+def restrict_samples(mt, eids):
+    """Keep only the columns of ``eids`` with a keyed semi-join."""
+    import hail as hl
+    eids_ht = hl.Table.parallelize(
+        [{'s': eid} for eid in set(eids)], hl.tstruct(s=hl.tstr), key='s'
+    )
+    return mt.semi_join_cols(eids_ht)
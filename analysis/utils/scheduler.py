@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BlockScheduler:
+    """Push blocks through stage -> process -> release with bounded pools.
+
+    At most ``n_workers`` blocks are processed at the same time and at most
+    ``n_prefetch`` further blocks are staged (e.g. copied to /cluster/) ahead
+    of them, so staging of the next blocks overlaps with processing of the
+    current ones."""
+
+    def __init__(self, n_workers=1, n_prefetch=1):
+        self.n_workers = max(1, n_workers)
+        self.n_prefetch = max(0, n_prefetch)
+
+    def run(self, blocks, process, stage=None, release=None):
+        """Return a dict block -> result of ``process`` or raised exception.
+
+        ``stage(block)`` returns the staged input passed on to
+        ``process(block, staged)``; ``release(block, staged)`` is always
+        called once the block is done, also when processing failed."""
+        working = threading.Semaphore(self.n_workers)
+        staging = threading.Semaphore(max(1, self.n_prefetch))
+
+        def run_one(block):
+            staged = None
+            if stage is not None:
+                with staging:
+                    staged = stage(block)
+            try:
+                with working:
+                    return process(block, staged)
+            finally:
+                if release is not None:
+                    release(block, staged)
+
+        results = {}
+        with ThreadPoolExecutor(self.n_workers + self.n_prefetch) as pool:
+            futures = {block: pool.submit(run_one, block) for block in blocks}
+            for block, future in futures.items():
+                try:
+                    results[block] = future.result()
+                except Exception as e:
+                    print(f'ERROR: {block}', flush=True)
+                    print(e, flush=True)
+                    results[block] = e
+        return results
+
+
+def run_parallel(items, fun, n_workers=1):
+    """Apply ``fun`` to all items with at most ``n_workers`` running at once,
+    return a dict item -> result or raised exception."""
+    return BlockScheduler(n_workers=n_workers, n_prefetch=0).run(
+        items, lambda item, staged: fun(item)
+    )
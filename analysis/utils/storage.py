@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from analysis.utils.metrics import metrics
+
+
+class StorageBackend:
+    """Database API behind PathDx (``dnax://`` paths).
+
+    Every call is counted and timed, see ``stats``, and recorded as
+    a ``dx.<name>`` metrics stage."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name, fun, *args, **fields):
+        start = time.perf_counter()
+        try:
+            with metrics.span(f'dx.{name}', **fields) as span:
+                result = fun(*args)
+                if isinstance(result, dict) and 'results' in result:
+                    span.update(n=len(result['results']))
+                return result
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                calls = self._stats.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                calls['calls'] += 1
+                calls['seconds'] += seconds
+
+    def stats(self):
+        """name -> number of calls and their total seconds."""
+        with self._lock:
+            return {name: dict(calls) for name, calls in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def find_databases(self, input_params):
+        return self._call('find_databases', self._find_databases, input_params)
+
+    def describe_database(self, database_id):
+        return self._call('describe_database', self._describe_database, database_id,
+                          database=database_id)
+
+    def list_folder(self, database_id, input_params):
+        return self._call('list_folder', self._list_folder, database_id, input_params,
+                          database=database_id, folder=input_params.get('folder'))
+
+    def create_database(self, name):
+        return self._call('create_database', self._create_database, name, database=name)
+
+    def url(self, path):
+        """Path of a ``dnax://`` PathDx to read and write with Hail."""
+        return str(path)
+
+
+class DxBackend(StorageBackend):
+    """The DNAnexus API, through dxpy."""
+
+    def _find_databases(self, input_params):
+        import dxpy
+        return dxpy.api.system_find_databases(input_params=input_params)
+
+    def _describe_database(self, database_id):
+        import dxpy
+        return dxpy.api.database_describe(database_id)
+
+    def _list_folder(self, database_id, input_params):
+        import dxpy
+        return dxpy.api.database_list_folder(database_id, input_params=input_params)
+
+    def _create_database(self, name):
+        # the databases are created through the Spark SQL catalog
+        from analysis.utils.load_spark import spark_session
+        spark_session().sql(f"CREATE DATABASE IF NOT EXISTS {name} LOCATION 'dnax://'")
+
+
+class LocalBackend(StorageBackend):
+    """DNAX databases mimicked by folders ``<root>/<database id>``.
+
+    The databases are registered in ``<root>/databases.json``. Listings
+    are paginated like the API, ``page_size`` results per page, and leave
+    out hidden files (names starting with '.' or '_', as in Hadoop)
+    unless includeHidden is set."""
+
+    def __init__(self, root, page_size=1000):
+        super().__init__()
+        self.root = os.path.abspath(root)
+        self.page_size = page_size
+        self._registry = os.path.join(self.root, 'databases.json')
+
+    def _databases(self):
+        if not os.path.exists(self._registry):
+            return {}
+        with open(self._registry) as f:
+            return json.load(f)
+
+    def _page(self, items, input_params):
+        start = int(input_params.get('starting') or 0)
+        end = start + input_params.get('limit', self.page_size)
+        return {'results': items[start:end], 'next': end if end < len(items) else None}
+
+    def _find_databases(self, input_params):
+        databases = sorted(self._databases().values(), key=lambda db: db['id'])
+        results = [
+            {'id': db['id'], 'describe': db} if input_params.get('describe') else {'id': db['id']}
+            for db in databases
+        ]
+        return self._page(results, input_params)
+
+    def _describe_database(self, database_id):
+        databases = self._databases()
+        if database_id not in databases:
+            raise ValueError(f'No database {database_id}')
+        return databases[database_id]
+
+    def _list_folder(self, database_id, input_params):
+        folder = input_params.get('folder', '/')
+        path = os.path.join(self.root, database_id, folder.lstrip('/'))
+        if os.path.isfile(path):
+            # like the API, files are listed without the database
+            return {'results': [{'path': folder}], 'next': None}
+        names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+        if not input_params.get('includeHidden'):
+            names = [name for name in names if not name.startswith(('.', '_'))]
+        results = [
+            {'path': f"dnax://{database_id}/{os.path.join(folder.strip('/'), name)}"}
+            for name in names
+        ]
+        return self._page(results, input_params)
+
+    def _create_database(self, name):
+        databases = self._databases()
+        if any(db['name'] == name for db in databases.values()):
+            return
+        database_id = 'database-' + hashlib.sha1(name.encode()).hexdigest()[:24]
+        databases[database_id] = {'id': database_id, 'name': name, 'class': 'database'}
+        os.makedirs(os.path.join(self.root, database_id), exist_ok=True)
+        with open(self._registry, 'w') as f:
+            json.dump(databases, f, indent=1)
+
+    def url(self, path):
+        return f"file://{os.path.join(self.root, path.database_id, path.folder.lstrip('/'))}"
+
+
+def default_backend():
+    """LocalBackend in $DNAX_LOCAL_ROOT if it is set, else DxBackend."""
+    root = os.environ.get('DNAX_LOCAL_ROOT')
+    return LocalBackend(root) if root else DxBackend()
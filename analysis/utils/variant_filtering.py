@@ -1,7 +1,9 @@
-import hail as hl
+from functools import reduce
 
 
 class VCFFilter:
+    QC_FILTERS = ('mean_read_depth', 'variant_missingness', 'hardy_weinberg', 'allele_balance')
+
     def __init__(self):
         pass
 
@@ -23,6 +25,7 @@ class VCFFilter:
         return demand_split
 
     def mean_read_depth(self, mt, min_depth=7):
+        import hail as hl
         mt = mt.filter_rows(
             hl.agg.mean(mt.DP) >= min_depth
         )
@@ -34,6 +37,7 @@ class VCFFilter:
 
     @_split_multi
     def allele_balance(self, mt, n_sample=1, sample_ratio=None, min_ratio=0.15):
+        import hail as hl
         mt = mt.filter_rows(
             hl.agg.any(
                 mt.GT.is_het()
@@ -50,3 +54,55 @@ class VCFFilter:
     @_split_multi
     def hardy_weinberg(self, mt, min_p_value=1e-15):
         return mt.filter_rows(mt.variant_qc.p_value_hwe >= min_p_value)
+
+    @_split_multi
+    def annotate_qc(self, mt, min_depth=7, min_call_rate=0.1, min_p_value=1e-15,
+                    min_ratio=0.15, qc_col_name='qc_pass'):
+        """Fused version of mean_read_depth, variant_missingness,
+        hardy_weinberg and allele_balance: compute only the needed per
+        variant statistics in one row aggregation and store a pass flag of
+        every filter in ``qc_col_name``. Use apply_qc to filter."""
+        import hail as hl
+        mt = mt.annotate_rows(_qc=hl.struct(
+            mean_dp=hl.agg.mean(mt.DP),
+            call_rate=hl.agg.fraction(hl.is_defined(mt.GT)),
+            p_value_hwe=hl.agg.hardy_weinberg_test(mt.GT).p_value,
+            allele_balance=(
+                hl.agg.any(
+                    mt.GT.is_het()
+                    & (hl.min(mt.AD) / hl.sum(mt.AD) >= min_ratio)
+                )
+                | hl.agg.all(~mt.GT.is_het())
+            ),
+        ))
+        return mt.transmute_rows(**{qc_col_name: hl.struct(
+            mean_read_depth=hl.coalesce(mt._qc.mean_dp >= min_depth, False),
+            variant_missingness=hl.coalesce(mt._qc.call_rate >= min_call_rate, False),
+            hardy_weinberg=hl.coalesce(mt._qc.p_value_hwe >= min_p_value, False),
+            allele_balance=hl.coalesce(mt._qc.allele_balance, False),
+        )})
+
+    def apply_qc(self, mt, qc_col_name='qc_pass'):
+        qc = mt[qc_col_name]
+        return mt.filter_rows(reduce(
+            lambda x, y: x & y, (qc[name] for name in self.QC_FILTERS)
+        ))
+
+    def qc_drop_counts(self, mt, qc_col_name='qc_pass', pass_genes=None):
+        """Count rows dropped by every filter of annotate_qc, each row is
+        attributed to the first filter it fails in QC_FILTERS order.
+
+        With ``pass_genes`` (a row expression), the set of its values in
+        the passing rows is collected in the same pass as ``genes``."""
+        import hail as hl
+        qc = mt[qc_col_name]
+        passed = hl.bool(True)
+        counts = {}
+        for name in self.QC_FILTERS:
+            counts[name] = hl.agg.count_where(passed & ~qc[name])
+            passed = passed & qc[name]
+        if pass_genes is not None:
+            counts['genes'] = hl.agg.filter(passed, hl.agg.collect_as_set(pass_genes))
+        return mt.aggregate_rows(hl.struct(
+            n_rows=hl.agg.count(), n_pass=hl.agg.count_where(passed), **counts
+        ))
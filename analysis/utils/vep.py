@@ -0,0 +1,52 @@
+import json
+
+import pkg_resources
+
+
+CANONICAL = 1
+TRANSCRIPT_FIELDS = ('canonical', 'biotype', 'gene_symbol', 'gene_id', 'lof', 'consequence_terms')
+ENTRY_FIELDS = ('GT', 'DP', 'AD')
+
+
+def slim_vep(vep, fields=TRANSCRIPT_FIELDS):
+    """Project a VEP struct to canonical protein coding transcript
+    consequences with only ``fields``. Projecting an already slim struct
+    gives the same struct; fields it lacks are left out."""
+    import hail as hl
+    element_type = vep.transcript_consequences.dtype.element_type
+    fields = [field for field in fields if field in element_type]
+    return hl.struct(
+        transcript_consequences=vep.transcript_consequences.filter(
+            lambda tc: (tc.canonical == CANONICAL) & (tc.biotype == 'protein_coding')
+        ).map(
+            lambda tc: tc.select(*fields)
+        )
+    )
+
+
+def slim_mt(mt, fields=TRANSCRIPT_FIELDS):
+    """Keep only the row and entry fields used for the LoF tables."""
+    mt = mt.select_rows(vep=slim_vep(mt.vep, fields), was_split=mt.was_split)
+    return mt.select_entries(*ENTRY_FIELDS)
+
+
+def write_service_config(path, vep_config_path, workers=4, batch_size=5000, buffer_size=100):
+    """Write a Hail VEP config at local ``path`` that streams variants
+    through the node's long-lived VEP workers (see vep_service.py) instead
+    of starting VEP for every partition.
+
+    The package has to be installed at the same location on all nodes."""
+    with open(vep_config_path) as f:
+        config = json.load(f)
+    service_path = pkg_resources.resource_filename('analysis', 'utils/vep_service.py')
+    config['command'] = [
+        'python3', service_path, 'client',
+        '--config', str(vep_config_path),
+        '--workers', str(workers),
+        '--batch-size', str(batch_size),
+        '--buffer-size', str(buffer_size),
+        '__OUTPUT_FORMAT_FLAG__',
+    ]
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=4)
+    return path
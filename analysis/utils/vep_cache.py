@@ -0,0 +1,142 @@
+import re
+import json
+import threading
+
+from analysis.utils.cache import fingerprint
+from analysis.utils.manifest import BlockManifest
+
+
+# version of the plugin cloned by preprocessing/install_vep.sh
+LOFTEE_VERSION = 'v1.0.4_GRCh38'
+
+
+def vep_versions(config):
+    """VEP release (from the docker image tag) and LOFTEE version of a VEP
+    config."""
+    command = ' '.join(config['command'])
+    m = re.search(r'ensembl-vep:release_([\d.]+)', command)
+    return {
+        'vep': config.get('vep_version', m.group(1) if m else None),
+        'loftee': config.get('loftee_version', LOFTEE_VERSION),
+    }
+
+
+class VEPCache:
+    """VEP results of split variants kept across blocks, reruns and data
+    releases.
+
+    Results are Hail Tables keyed by locus/alleles, written to ``folder``
+    as ``vep-<key>-<contig>-<n>.ht`` parts; ``key`` is a fingerprint of the
+    VEP and LOFTEE versions, the VEP command and the output schema, so
+    a config change starts a new cache. The parts of each contig are
+    listed in ``vep-<key>.json`` and merged into a single part once there
+    are more than ``max_parts`` of them; ``remove_merged`` deletes the
+    merged parts."""
+
+    def __init__(self, folder, config_path, max_parts=16):
+        with open(config_path) as f:
+            config = json.load(f)
+        self.versions = vep_versions(config)
+        self.key = fingerprint(self.versions, config['command'], config['vep_json_schema'])
+        self.folder = folder
+        self.max_parts = max_parts
+        self.index = BlockManifest(folder / f'vep-{self.key}.json')
+        self.index.load()
+        self._n = len(self.index.blocks)
+        self._lock = threading.RLock()
+        self._compacting = set()
+
+    def parts(self, contig):
+        with self._lock:
+            return sorted(
+                name for name, record in list(self.index.blocks.items())
+                if record.get('contig') == contig and record.get('status') == 'done'
+            )
+
+    def read(self, contig):
+        """All cached results of ``contig``, None if there are none."""
+        import hail as hl
+        tables = [hl.read_table((self.folder / name).rstr) for name in self.parts(contig)]
+        if not tables:
+            return None
+        return tables[0].union(*tables[1:])
+
+    def _write(self, ht, contig):
+        """Write a new part, not listed yet; return its path and number
+        of rows."""
+        import hail as hl
+        with self._lock:
+            path = self.folder / f'vep-{self.key}-{contig}-{self._n}.ht'
+            self._n += 1
+        ht.write(path.rstr, overwrite=True)
+        path.invalidate()
+        return path, hl.read_table(path.rstr).count()
+
+    def lookup(self, sites, config_path, contig):
+        """Return the VEP results of the ``sites`` table, a table keyed by
+        locus/alleles with a ``vep`` field. VEP runs only for the sites
+        which are not cached yet and their results are cached."""
+        import hail as hl
+        cached = self.read(contig)
+        sites = sites.select()
+        if cached is not None:
+            sites = sites.anti_join(cached)
+        n_new = sites.count()
+        if n_new:
+            new = hl.vep(sites, config_path.rstr).select('vep')
+            path, n_new = self._write(new, contig)
+            self.index.update(path.name, status='done', contig=contig, n_rows=n_new)
+        print(f'....{n_new} variants sent to VEP', flush=True)
+        self.compact(contig)
+        vep_ht = self.read(contig)
+        return hl.vep(sites, config_path.rstr).select('vep') if vep_ht is None else vep_ht
+
+    def annotate(self, mt, config_path, contig):
+        """Annotate the rows of ``mt`` with ``vep`` using the cache."""
+        vep_ht = self.lookup(mt.rows(), config_path, contig)
+        return mt.annotate_rows(vep=vep_ht[mt.row_key].vep)
+
+    def compact(self, contig):
+        """Merge the parts of ``contig`` if there are too many of them.
+
+        The merged part is written while the other blocks keep reading
+        and adding parts; only the swap of the index records holds the
+        lock."""
+        import hail as hl
+        with self._lock:
+            parts = self.parts(contig)
+            if len(parts) <= self.max_parts or contig in self._compacting:
+                return
+            self._compacting.add(contig)
+        try:
+            print(f'....merging {len(parts)} VEP cache parts of {contig}', flush=True)
+            tables = [hl.read_table((self.folder / name).rstr) for name in parts]
+            path, n_rows = self._write(tables[0].union(*tables[1:]), contig)
+            with self._lock:
+                records = {name: {'status': 'merged'} for name in parts}
+                records[path.name] = {
+                    'status': 'done', 'contig': contig, 'n_rows': n_rows, 'merged': parts,
+                }
+                self.index.update_many(records)
+        finally:
+            with self._lock:
+                self._compacting.discard(contig)
+
+    def remove_merged(self):
+        """Delete the parts merged by ``compact``. Tables read before a
+        merge still read its parts, so call this once no block reads the
+        cache, e.g. at the end of a run. The index keeps their records,
+        as 'removed', so that part names aren't reused."""
+        import hail as hl
+        with self._lock:
+            merged = [
+                name for name, record in list(self.index.blocks.items())
+                if record.get('status') == 'merged'
+            ]
+        for name in merged:
+            path = self.folder / name
+            hl.current_backend().fs.rmtree(path.rstr)
+            path.invalidate()
+        if merged:
+            print(f'Removed {len(merged)} merged VEP cache parts', flush=True)
+            self.index.update_many({name: {'status': 'removed'} for name in merged})
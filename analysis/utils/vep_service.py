@@ -0,0 +1,290 @@
+"""Long-lived VEP workers shared by all Hail VEP calls on a node.
+
+``client`` is the command Hail runs for every partition. It sends the VCF
+records from stdin in batches to the node's server over a Unix socket,
+starting the server if there is none, and prints the annotations in input
+order. ``server`` keeps ``--workers`` VEP processes running, so the VEP
+cache, the LOFTEE plugin, human_ancestor.fa.gz and loftee.sql are loaded
+once per node instead of once per partition.
+
+This file only uses the standard library, it is run as a script on the
+executors: python3 vep_service.py client --config vep-config.json ...
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import queue
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+SOCKET_PATH = '/tmp/vep-service.sock'
+LOCK_PATH = '/tmp/vep-service.lock'
+HEADER = b'##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+# VEP reads its input in chunks of --buffer_size records; after every batch
+# dummy records with a unique ID are sent to push the batch through VEP
+FLUSH_ID = b'vep_service_flush'
+FLUSH_RECORD = b'chr1\t69134\t%s\tA\tG\t.\t.\t.\n'
+
+
+def send_frame(conn, data):
+    conn.sendall(struct.pack('!Q', len(data)) + data)
+
+
+def recv_exactly(conn, n):
+    chunks = []
+    while n:
+        chunk = conn.recv(min(n, 2 ** 20))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(conn):
+    n, = struct.unpack('!Q', recv_exactly(conn, 8))
+    return recv_exactly(conn, n)
+
+
+def vep_command(config_path, output_format_flag='--json'):
+    with open(config_path) as f:
+        config = json.load(f)
+    command = [
+        output_format_flag if arg == '__OUTPUT_FORMAT_FLAG__' else arg
+        for arg in config['command']
+    ]
+    env = dict(os.environ, **config.get('env', {}))
+    return command, env
+
+
+class VEPWorker:
+    def __init__(self, command, env, buffer_size):
+        self.buffer_size = buffer_size
+        self.seq = 0
+        self.proc = subprocess.Popen(
+            command + ['--buffer_size', str(buffer_size)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+        )
+        # the input is written by its own thread while annotate reads the
+        # output: VEP stops reading once its output fills the pipe
+        self._input = queue.Queue()
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+        self._input.put(HEADER)
+
+    def _feed(self):
+        while True:
+            data = self._input.get()
+            if data is None:
+                return
+            try:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+            except (OSError, ValueError):
+                # VEP exited, annotate finds out from its output
+                return
+
+    def annotate(self, records):
+        """Return the VEP output lines of ``records`` (VCF lines)."""
+        self.seq += 1
+        flush_id = FLUSH_ID + b'_%d_end' % self.seq
+        # two buffers of dummy records: the first completes the chunk with
+        # the last records, the second makes VEP write it out
+        self._input.put(records)
+        self._input.put(FLUSH_RECORD % flush_id * (2 * self.buffer_size))
+
+        out = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError(f'VEP exited with {self.proc.poll()}')
+            if FLUSH_ID in line:
+                if flush_id in line:
+                    return out
+                continue
+            out.append(line)
+
+    def kill(self):
+        self.proc.kill()
+        self._input.put(None)
+
+    def close(self):
+        # VEP writes the output of the last flush records before it exits
+        threading.Thread(target=self.proc.stdout.read, daemon=True).start()
+        self._input.put(None)
+        self._feeder.join()
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def serve(args):
+    command, env = vep_command(args.config)
+    workers = queue.Queue()
+    for _ in range(args.workers):
+        workers.put(VEPWorker(command, env, args.buffer_size))
+
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(SOCKET_PATH)
+    sock.listen(64)
+    sock.settimeout(args.idle_timeout)
+
+    # workers which failed and couldn't be restarted leave the pool
+    size = args.workers
+    size_lock = threading.Lock()
+
+    def take_worker():
+        while size:
+            try:
+                return workers.get(timeout=1)
+            except queue.Empty:
+                continue
+        return None
+
+    def replace_worker():
+        nonlocal size
+        try:
+            workers.put(VEPWorker(command, env, args.buffer_size))
+        except Exception as e:
+            print(f'VEP worker not restarted: {e}', file=sys.stderr, flush=True)
+            with size_lock:
+                size -= 1
+
+    def handle(conn):
+        with conn:
+            try:
+                records = recv_frame(conn)
+            except ConnectionError:
+                # a client checking that the server is up
+                return
+            worker = take_worker()
+            if worker is None:
+                send_frame(conn, b'1No VEP workers left')
+                return
+            try:
+                out = worker.annotate(records)
+            except Exception as e:
+                worker.kill()
+                try:
+                    send_frame(conn, b'1' + str(e).encode())
+                finally:
+                    replace_worker()
+            else:
+                workers.put(worker)
+                send_frame(conn, b'0' + b''.join(out))
+
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                # idle: stop the workers, the next client starts a new server
+                if workers.qsize() == size:
+                    break
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    finally:
+        os.unlink(SOCKET_PATH)
+        while not workers.empty():
+            workers.get().close()
+
+
+def connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SOCKET_PATH)
+    return sock
+
+
+def ensure_server(args):
+    """Start the node's server unless it is already running."""
+    try:
+        connect().close()
+        return
+    except OSError:
+        pass
+    with open(LOCK_PATH, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            connect().close()
+            return
+        except OSError:
+            pass
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'server',
+             '--config', args.config,
+             '--workers', str(args.workers),
+             '--buffer-size', str(args.buffer_size),
+             '--idle-timeout', str(args.idle_timeout)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + args.start_timeout
+        while time.monotonic() < deadline:
+            try:
+                connect().close()
+                return
+            except OSError:
+                time.sleep(1)
+        raise TimeoutError('VEP service did not start')
+
+
+def request(records):
+    with connect() as sock:
+        send_frame(sock, records)
+        response = recv_frame(sock)
+    if response[:1] != b'0':
+        raise RuntimeError(response[1:].decode())
+    return response[1:]
+
+
+def client(args):
+    if args.output_format_flag != '--json':
+        # only JSON output is served, run VEP directly for anything else
+        command, env = vep_command(args.config, args.output_format_flag)
+        sys.exit(subprocess.run(command, env=env).returncode)
+
+    records = [
+        line for line in sys.stdin.buffer.read().splitlines(keepends=True)
+        if not line.startswith(b'#')
+    ]
+    batches = [
+        b''.join(records[i:i + args.batch_size])
+        for i in range(0, len(records), args.batch_size)
+    ]
+    ensure_server(args)
+    with ThreadPoolExecutor(args.workers) as pool:
+        for out in pool.map(request, batches):
+            sys.stdout.buffer.write(out)
+    sys.stdout.buffer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode', choices=['client', 'server'])
+    # Hail replaces __OUTPUT_FORMAT_FLAG__ in the config command with one of these
+    parser.add_argument('--json', dest='output_format_flag', action='store_const', const='--json')
+    parser.add_argument('--vcf', dest='output_format_flag', action='store_const', const='--vcf')
+    parser.add_argument('--config', required=True, help='VEP config JSON with the command to run')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=5000, help='records per request')
+    parser.add_argument('--buffer-size', type=int, default=100, help='VEP --buffer_size')
+    parser.add_argument('--idle-timeout', type=int, default=1800)
+    parser.add_argument('--start-timeout', type=int, default=600)
+    args = parser.parse_args()
+    args.output_format_flag = args.output_format_flag or '--json'
+    if args.mode == 'server':
+        serve(args)
+    else:
+        client(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""End to end benchmark of the annotation and LoF table pipeline on local
+Spark, with synthetic pVCF blocks and a stub VEP.
+
+    python benchmarks/run_benchmarks.py --samples 500 --variants 20000 --blocks 2
+    python benchmarks/run_benchmarks.py --baseline old/report.json
+
+Reports the throughput of split_annotate and the QC filters in
+variants/s and of _chr_table in samples x genes/s; with ``--baseline``
+exits with 1 if a stage got slower than ``--tolerance``.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+import hail as hl
+import pkg_resources
+
+from analysis.cmd import split_vep
+from analysis.utils.dxpathlib import PathDx
+from analysis.utils.manifest import BlockManifest
+from analysis.utils.metrics import metrics
+from analysis.utils.samples import SampleIndex
+from analysis.utils.variant_filtering import VCFFilter
+from analysis.utils.vep import slim_mt
+
+from synthetic_pvcf import write_block
+
+
+STUB_VEP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_vep.py')
+
+
+def write_stub_config(path, lof_rate, gene_span):
+    """The pipeline's VEP config with the command replaced by the stub."""
+    config_path = pkg_resources.resource_filename('analysis', 'utils/vep-config.json')
+    with open(config_path) as f:
+        config = json.load(f)
+    config['command'] = [
+        sys.executable, STUB_VEP,
+        '--lof-rate', str(lof_rate), '--gene-span', str(gene_span),
+        '__OUTPUT_FORMAT_FLAG__',
+    ]
+    config['env'] = {}
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def timed(results, name, work, unit, fun, *args, **kwargs):
+    start = time.perf_counter()
+    out = fun(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': round(seconds, 3), unit: round(work / seconds, 1)}
+    print(f'{name}: {seconds:.1f} s, {work / seconds:,.1f} {unit}', flush=True)
+    return out
+
+
+def compare(results, baseline, tolerance):
+    """Names of the stages slower than ``baseline`` by more than ``tolerance``."""
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['seconds'], result['seconds']
+        print(f'{name}: {old:.1f} s -> {new:.1f} s ({(new - old) / old:+.0%})')
+        if new > old * (1 + tolerance):
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workdir', default='/tmp/loftee-benchmark')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--variants', type=int, default=20_000, help='records per block')
+    parser.add_argument('--blocks', type=int, default=2)
+    parser.add_argument('--multiallelic-rate', type=float, default=0.05)
+    parser.add_argument('--lof-rate', type=float, default=0.02)
+    parser.add_argument('--gene-span', type=int, default=20_000, help='bases per synthetic gene')
+    parser.add_argument('--format', default='csv')
+    parser.add_argument('--slim', action='store_true')
+    parser.add_argument('--baseline', help='report.json of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    work = PathDx(args.workdir)
+    for folder in ('vcf', 'mt', 'work', 'out'):
+        (work / folder).mkdir(parents=True)
+    hl.init(
+        master='local[*]', default_reference='GRCh38',
+        tmp_dir=(work / 'tmp').rstr, log=str(work / 'hail.log'),
+    )
+    metrics.start(str(work / 'metrics.jsonl'))
+    config = PathDx(write_stub_config(work / 'stub-vep.json', args.lof_rate, args.gene_span))
+
+    results = {}
+    samples = [str(1_000_000 + i) for i in range(args.samples)]
+    n_variants = args.variants * args.blocks
+    spacing = 20
+    vcfs = [work / 'vcf' / f'ukb23157_c1_b{b}_v1.vcf.gz' for b in range(args.blocks)]
+
+    def generate():
+        for b, vcf in enumerate(vcfs):
+            write_block(
+                vcf, contig='chr1', start=1_000_000 + b * args.variants * 2 * spacing,
+                samples=samples, n_variants=args.variants,
+                multiallelic_rate=args.multiallelic_rate, spacing=spacing, seed=b,
+            )
+    timed(results, 'generate', n_variants, 'variants/s', generate)
+
+    manifest = BlockManifest(work / 'mt' / BlockManifest.FILE_NAME)
+    sample_index = SampleIndex(work / 'mt', manifest)
+    mts = [work / 'mt' / split_vep.mt_name('1', b) for b in range(args.blocks)]
+
+    def annotate():
+        for vcf, mt in zip(vcfs, mts):
+            split_vep.split_annotate(vcf, mt, vep_config_path=config, slim=args.slim)
+            n_rows, n_cols = hl.read_matrix_table(mt.rstr).count()
+            manifest.update(mt.name, status='done', path=mt.rstr, n_rows=n_rows, n_cols=n_cols)
+            sample_index.record(mt.name, mt)
+    timed(results, 'split_annotate', n_variants, 'variants/s', annotate)
+
+    mt_filter = VCFFilter()
+    mt = hl.MatrixTable.union_rows(*[slim_mt(hl.read_matrix_table(mt.rstr)) for mt in mts])
+    n_split = mt.count_rows()
+
+    def fused_qc():
+        return mt_filter.apply_qc(mt_filter.annotate_qc(mt)).count_rows()
+    timed(results, 'qc_fused', n_split, 'variants/s', fused_qc)
+
+    def qc_chain():
+        mt_qc = mt_filter.mean_read_depth(mt)
+        mt_qc = hl.variant_qc(mt_qc)
+        mt_qc = mt_filter.variant_missingness(mt_qc)
+        mt_qc = mt_filter.hardy_weinberg(mt_qc)
+        mt_qc = mt_filter.allele_balance(mt_qc, n_sample=1)
+        return mt_qc.count_rows()
+    timed(results, 'qc_chain', n_split, 'variants/s', qc_chain)
+
+    # genes are --gene-span windows of the generated positions
+    last = 1_000_000 + args.blocks * args.variants * 2 * spacing
+    n_genes = last // args.gene_span - 1_000_000 // args.gene_span + 1
+    timed(
+        results, 'chr_table', args.samples * n_genes, 'samples x genes/s',
+        split_vep._chr_table, '1', mts, None,
+        output_format=args.format, sample_index=sample_index,
+        work_dir=str(work / 'work'), out_dir=str(work / 'out'),
+    )
+
+    report = {'params': vars(args), 'results': results}
+    with open(work / 'report.json', 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Report: {work / "report.json"}, stages: {work / "metrics.jsonl"}')
+
+    if baseline is not None:
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print(f'Slower than the baseline: {", ".join(slower)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Synthetic bgzipped pVCF blocks shaped like the UKB exome release.
+
+    python benchmarks/synthetic_pvcf.py out.vcf.gz --samples 500 --variants 20000
+"""
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+
+# empty BGZF block terminating a .vcf.gz
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+BGZF_BLOCK_SIZE = 0xff00
+BASES = np.array(list('ACGT'))
+# read depths of the synthetic genotypes, the first is below the QC minimum
+DEPTHS = (4, 15, 30)
+
+
+class BGZFWriter:
+    """Minimal BGZF writer: gzip members of at most 64 KiB of data with
+    the BC extra field, as written by bgzip."""
+
+    def __init__(self, path, level=6):
+        self.f = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def _block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        header = struct.pack(
+            '<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+            ord('B'), ord('C'), 2, len(cdata) + 25,
+        )
+        self.f.write(header + cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self.buffer:
+            self._block(bytes(self.buffer))
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def header(contig, samples):
+    lines = [
+        '##fileformat=VCFv4.2',
+        '##FILTER=<ID=PASS,Description="All filters passed">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">',
+        '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+        f'##contig=<ID={contig},length=248956422>',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples),
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def entry_templates(n_alts):
+    """Entries by genotype: hom-ref, then het and hom-alt of every ALT,
+    each at all DEPTHS, and the missing entry last."""
+    def ad(dp, alleles):
+        depths = [0] * (n_alts + 1)
+        for a in alleles:
+            depths[a] += dp // len(alleles)
+        return ','.join(map(str, depths))
+
+    genotypes = [(0, 0)] + [(0, a) for a in range(1, n_alts + 1)] + [(a, a) for a in range(1, n_alts + 1)]
+    templates = [
+        f'{g[0]}/{g[1]}:{min(99, 3 * dp)}:{dp}:{ad(dp, sorted(set(g)))}'
+        for g in genotypes for dp in DEPTHS
+    ]
+    return np.array(templates + ['./.:.:.:.']), len(genotypes)
+
+
+def genotype_probabilities(afs, missing_rate):
+    """Hardy-Weinberg probabilities of the genotypes of entry_templates."""
+    ref = 1 - afs.sum()
+    probs = [ref ** 2] + [2 * ref * af for af in afs] + [af ** 2 for af in afs]
+    probs = np.array(probs) / sum(probs) * (1 - missing_rate)
+    return np.append(probs, missing_rate)
+
+
+def write_block(path, contig='chr1', start=1_000_000, samples=None, n_variants=10_000,
+                multiallelic_rate=0.05, missing_rate=0.01, spacing=20, seed=0):
+    """Write a synthetic pVCF block, return the number of records."""
+    rng = np.random.default_rng(seed)
+    samples = samples or [str(1_000_000 + i) for i in range(100)]
+    n_samples = len(samples)
+    templates = {n: entry_templates(n) for n in (1, 2)}
+    with BGZFWriter(path) as f:
+        f.write(header(contig, samples).encode())
+        positions = start + np.cumsum(rng.integers(1, 2 * spacing, size=n_variants))
+        for pos in positions:
+            n_alts = 2 if rng.random() < multiallelic_rate else 1
+            bases = rng.permutation(BASES)
+            ref, alts = bases[0], bases[1:n_alts + 1]
+            # mostly rare variants, as in the exome release
+            afs = 10 ** rng.uniform(-4, -1, size=n_alts)
+            entries, n_genotypes = templates[n_alts]
+            probs = genotype_probabilities(afs, missing_rate)
+            genotype = rng.choice(len(probs), size=n_samples, p=probs)
+            depth = rng.choice(len(DEPTHS), size=n_samples, p=(0.05, 0.45, 0.5))
+            index = np.where(
+                genotype < n_genotypes, genotype * len(DEPTHS) + depth, len(entries) - 1
+            )
+            fields = [contig, str(pos), '.', ref, ','.join(alts), '.', 'PASS', '.', 'GT:GQ:DP:AD']
+            f.write(('\t'.join(fields) + '\t' + '\t'.join(entries[index]) + '\n').encode())
+    return n_variants
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path')
+    parser.add_argument('--contig', default='chr1')
+    parser.add_argument('--start', type=int, default=1_000_000)
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--variants', type=int, default=10_000)
+    parser.add_argument('--multiallelic-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_block(
+        args.path, contig=args.contig, start=args.start,
+        samples=[str(1_000_000 + i) for i in range(args.samples)],
+        n_variants=args.variants, multiallelic_rate=args.multiallelic_rate, seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    main()
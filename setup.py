@@ -9,8 +9,9 @@ setup(
     include_package_data=True,
     entry_points={
         'console_scripts': [
-            'annotate_vcf = analysis.cmd.split_vep:annotate_vcf',
-            'rare_variants_table = analysis.cmd.split_vep:rare_variants_table',
+            'annotate_vcf = analysis.cmd.split_vep:main_annotate_vcf',
+            'rare_variants_table = analysis.cmd.split_vep:main_rare_variants_table',
+            'metrics_summary = analysis.cmd.metrics_summary:main',
             'install_vep = preprocessing.install_vep:main',
         ]
     },
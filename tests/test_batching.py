@@ -0,0 +1,68 @@
+import pytest
+
+from analysis.utils import batching
+from analysis.utils.batching import BYTES_PER_ENTRY, parse_memory, plan_batches, target_partitions
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('512', 512),
+    ('1k', 2 ** 10),
+    ('512m', 512 * 2 ** 20),
+    ('80G', 80 * 2 ** 30),
+    (' 2gb ', 2 * 2 ** 30),
+    ('1T', 2 ** 40),
+])
+def test_parse_memory(value, expected):
+    assert parse_memory(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'g', '1.5g', '10x', '-1g'])
+def test_parse_memory_invalid(value):
+    with pytest.raises(ValueError):
+        parse_memory(value)
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    # 2 executors of 1 kB, 4 cores: batches of up to 4 * 2 kB of entries
+    # and 4 * 4 partitions
+    monkeypatch.setattr(batching, 'cluster_resources', lambda: (2 ** 10, 2, 4))
+
+
+def block(n_bytes, n_partitions=1):
+    return (n_bytes // BYTES_PER_ENTRY, 1, n_partitions)
+
+
+def test_plan_batches_memory(cluster):
+    max_bytes = 4 * 2 ** 11
+    # exactly at the budget stays in the batch, one entry more starts a new one
+    assert plan_batches([block(max_bytes // 2)] * 2) == [(0, 2)]
+    assert plan_batches([block(max_bytes // 2), block(max_bytes // 2 + BYTES_PER_ENTRY)]) == [(0, 1), (1, 2)]
+    assert plan_batches([block(max_bytes // 4)] * 9) == [(0, 4), (4, 8), (8, 9)]
+
+
+def test_plan_batches_oversized_block(cluster):
+    # a block over the budget still gets a batch of its own
+    assert plan_batches([block(100), block(10 ** 6), block(100)]) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_plan_batches_partitions(cluster):
+    assert plan_batches([block(16, 8)] * 3) == [(0, 2), (2, 3)]
+    assert plan_batches([block(16, 16), block(16, 1)]) == [(0, 1), (1, 2)]
+
+
+def test_plan_batches_empty(cluster):
+    assert plan_batches([]) == []
+
+
+def test_target_partitions():
+    partition_bytes = 128 * 2 ** 20
+    n_cols = 1000
+    rows_per_partition = partition_bytes // (n_cols * BYTES_PER_ENTRY)
+    assert target_partitions(rows_per_partition, n_cols) == 1
+    assert target_partitions(rows_per_partition + 1, n_cols) == 2
+    assert target_partitions(10 * rows_per_partition, n_cols) == 10
+    assert target_partitions(0, n_cols) == 1
+    # a row larger than a partition
+    assert target_partitions(5, 10 ** 7) == 5
+    assert target_partitions(10, 0) == 1
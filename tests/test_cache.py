@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import pytest
+
+from analysis.utils.cache import StageCache, fingerprint
+
+
+def test_fingerprint():
+    key = fingerprint('qc', {'b': 1, 'a': [1, 2]}, Path('/data'))
+    assert len(key) == 16
+    # dict order doesn't matter, the values do
+    assert fingerprint('qc', {'a': [1, 2], 'b': 1}, Path('/data')) == key
+    assert fingerprint('qc', {'a': [2, 1], 'b': 1}, Path('/data')) != key
+    assert fingerprint('qc', {'b': 1, 'a': [1, 2]}) != key
+    assert fingerprint('union', {'b': 1, 'a': [1, 2]}, Path('/data')) != key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return StageCache(tmp_path / 'cache')
+
+
+def write_output(path):
+    path.mkdir(parents=True)
+    (path / 'part-0').touch()
+
+
+def test_stage_cache_missing(cache, tmp_path):
+    path, info = cache.lookup('qc', 'abc')
+    assert path == tmp_path / 'cache' / 'qc-abc.mt'
+    assert info is None
+
+
+def test_stage_cache_reuse(cache):
+    path, _ = cache.lookup('result', 'abc', suffix='.bm')
+    write_output(path)
+    (path / '_SUCCESS').touch()
+    assert cache.save(path, {'gene_names': ['A', 'B']}) == {'gene_names': ['A', 'B']}
+    assert cache.lookup('result', 'abc', suffix='.bm') == (path, {'gene_names': ['A', 'B']})
+    assert cache.lookup('result', 'abc')[1] is None
+    assert cache.lookup('result', 'other', suffix='.bm')[1] is None
+
+
+def test_stage_cache_incomplete_output(cache):
+    # an interrupted write leaves the output without _SUCCESS
+    path, _ = cache.lookup('qc', 'abc')
+    write_output(path)
+    cache.save(path, {'n_samples': 3})
+    assert cache.lookup('qc', 'abc') == (path, None)
+
+
+def test_stage_cache_info_missing(cache):
+    # the output was written, the run stopped before saving its info
+    path, _ = cache.lookup('qc', 'abc')
+    write_output(path)
+    (path / '_SUCCESS').touch()
+    assert cache.lookup('qc', 'abc') == (path, None)
@@ -0,0 +1,51 @@
+import sys
+import json
+import subprocess
+
+# fails if hail or pyspark were imported
+NO_SPARK = 'assert not any(m.split(".")[0] in ("hail", "pyspark") for m in sys.modules), sys.modules\n'
+
+
+def run(code):
+    """Run ``code`` in a fresh interpreter, so that no other test has
+    imported hail yet."""
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_help_without_hail():
+    stdout = run(
+        'import sys\n'
+        'import analysis.cmd.split_vep as split_vep\n'
+        'try:\n'
+        '    split_vep.parser("split_vep").parse_args(["--help"])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        + NO_SPARK
+    )
+    assert '--masks' not in stdout
+    assert '--profile' in stdout
+
+
+def test_dry_run_without_hail(tmp_path):
+    manifest = tmp_path / '_manifest.json'
+    manifest.write_text(json.dumps({
+        'chr-1-b0.mt': {'status': 'done', 'n_rows': 10},
+        'chr-1-b1.mt': {'status': 'done', 'n_rows': 20},
+        'chr-2-b0.mt': {'status': 'failed'},
+    }))
+    stdout = run(
+        'import sys\n'
+        'import analysis.cmd.split_vep as split_vep\n'
+        f'split_vep.manifest_cache_path = {str(manifest)!r}\n'
+        'split_vep.vcf_blocks = lambda: iter([\n'
+        '    (f"ukb23157_c{c}_b{b}_v1.vcf.gz", c, b) for c, b in [("1", "0"), ("1", "1"), ("2", "0")]\n'
+        '])\n'
+        'split_vep.chrs = ["1", "2"]\n'
+        'assert [name for p, c, name in split_vep.annotate_vcf(dry_run=True)] == ["chr-2-b0.mt"]\n'
+        'assert split_vep.rare_variants_table(dry_run=True) == ["1"]\n'
+        + NO_SPARK
+    )
+    assert '1 blocks to annotate' in stdout
+    assert 'Chr 1: 2 blocks, 30 variants' in stdout
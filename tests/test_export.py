@@ -0,0 +1,266 @@
+import gzip
+import json
+from itertools import chain
+
+import numpy as np
+import pytest
+
+from analysis.utils import export
+from analysis.utils.export import (
+    BlockGzipWriter, ExportProgress, export_matrix, export_sparse, format_csv_rows, sparse_slabs,
+    write_csv_gz,
+)
+
+
+def baseline_csv(samples, gene_names, zero_genes, arr):
+    """The CSV lines written by the original export, line by line."""
+    lines = [f"s,{','.join(chain(gene_names, zero_genes))}\n"]
+    for i in range(arr.shape[0]):
+        lines.append(f"{samples[i]},{','.join(chain(map(str, arr[i, :]), '0' * len(zero_genes)))}\n")
+    return ''.join(lines).encode()
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 10, size=(37, 11)).astype(np.int8)
+    samples = [str(1_000_000 + i) for i in range(arr.shape[0])]
+    gene_names = [f'GENE{i}' for i in range(arr.shape[1])]
+    return samples, gene_names, ['ZERO1', 'ZERO2', 'ZERO3'], arr
+
+
+def slabs(arr, size):
+    return [(start, arr[start:start + size]) for start in range(0, arr.shape[0], size)]
+
+
+@pytest.mark.parametrize('n_zero', [0, 3])
+@pytest.mark.parametrize('chunk_bytes', [1, 100, 2 ** 20])
+def test_format_csv_rows(table, n_zero, chunk_bytes):
+    samples, gene_names, zero_genes, arr = table
+    zero_genes = zero_genes[:n_zero]
+    header, expected = baseline_csv(samples, gene_names, zero_genes, arr).split(b'\n', 1)
+    out = b''.join(format_csv_rows(samples, arr, n_zero=n_zero, chunk_bytes=chunk_bytes))
+    assert out == expected
+
+
+def test_format_csv_rows_edge_cases():
+    assert b''.join(format_csv_rows([], np.zeros((0, 3), dtype=np.int8))) == b''
+    assert b''.join(format_csv_rows(['a'], np.zeros((1, 0), dtype=np.int8), n_zero=2)) == b'a,0,0\n'
+    with pytest.raises(ValueError):
+        list(format_csv_rows(['a'], np.array([[10]], dtype=np.int8)))
+    with pytest.raises(ValueError):
+        list(format_csv_rows(['a'], np.array([[-1]], dtype=np.int8)))
+
+
+def test_block_gzip_writer(tmp_path):
+    data = bytes(range(256)) * 1000
+    path = tmp_path / 'out.gz'
+    with BlockGzipWriter(path, n_threads=3, chunk_size=1000) as f:
+        for i in range(0, len(data), 777):
+            f.write(data[i:i + 777])
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_block_gzip_writer_offset(tmp_path):
+    path = tmp_path / 'out.gz'
+    with BlockGzipWriter(path, chunk_size=10) as f:
+        f.write(b'first line\n')
+        size = f.flush()
+        f.write(b'lost line\n')
+    with BlockGzipWriter(path, chunk_size=10, offset=size) as f:
+        f.write(b'second line\n')
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == b'first line\nsecond line\n'
+
+
+def test_block_gzip_writer_compressed(tmp_path):
+    src = tmp_path / 'src.gz'
+    with gzip.open(src, 'wb') as f:
+        f.write(b'copied\n')
+    path = tmp_path / 'out.gz'
+    with BlockGzipWriter(path) as f:
+        f.write(b'header\n')
+        with open(src, 'rb') as shard:
+            f.write_compressed(shard)
+        f.write(b'footer\n')
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == b'header\ncopied\nfooter\n'
+
+
+def test_write_csv_gz(table, tmp_path):
+    samples, gene_names, zero_genes, arr = table
+    path = tmp_path / 'out.csv.gz'
+    write_csv_gz(path, samples, gene_names, zero_genes, slabs(arr, 10), n_threads=2)
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == baseline_csv(samples, gene_names, zero_genes, arr)
+
+
+def test_write_csv_gz_slab_order(table, tmp_path):
+    samples, gene_names, zero_genes, arr = table
+    with pytest.raises(ValueError, match='follows row 0'):
+        write_csv_gz(tmp_path / 'out.csv.gz', samples, gene_names, zero_genes, slabs(arr, 10)[1:])
+
+
+def test_export_progress_resume(table, tmp_path, monkeypatch):
+    samples, gene_names, zero_genes, arr = table
+    expected = tmp_path / 'expected.csv.gz'
+    write_csv_gz(
+        expected, samples, gene_names, zero_genes, slabs(arr, 10),
+        progress=ExportProgress(str(expected), 'key'),
+    )
+
+    # the export fails in the middle of the third slab, after part of it
+    # is written out
+    def failing_format(names, arr, n_zero=0):
+        for i, chunk in enumerate(format_csv_rows(names, arr, n_zero=n_zero, chunk_bytes=1)):
+            if names[0] == samples[20] and i == 3:
+                raise RuntimeError('interrupted')
+            yield chunk
+
+    path = tmp_path / 'out.csv.gz'
+    progress = ExportProgress(str(path), 'key')
+    monkeypatch.setattr(export, 'format_csv_rows', failing_format)
+    with pytest.raises(RuntimeError):
+        write_csv_gz(path, samples, gene_names, zero_genes, slabs(arr, 10), progress=progress)
+    rows, size, complete = progress.load()
+    assert (rows, complete) == (20, False)
+    assert path.stat().st_size > size
+    assert ExportProgress(str(path), 'other key').load() == (0, 0, False)
+
+    monkeypatch.undo()
+    write_csv_gz(
+        path, samples, gene_names, zero_genes, slabs(arr, 10)[rows // 10:], progress=progress,
+    )
+    progress.complete()
+    assert progress.load() == (arr.shape[0], path.stat().st_size, True)
+    assert path.read_bytes() == expected.read_bytes()
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == baseline_csv(samples, gene_names, zero_genes, arr)
+
+
+def dense(arr, zero_genes):
+    """``arr`` with the all-zero columns of ``zero_genes`` appended."""
+    return np.hstack([arr, np.zeros((arr.shape[0], len(zero_genes)), dtype=np.int8)])
+
+
+def check_metadata(path, samples, gene_names, zero_genes):
+    with open(f'{path}.json') as f:
+        meta = json.load(f)
+    assert meta == {
+        'shape': [len(samples), len(gene_names) + len(zero_genes)],
+        'dtype': 'int8',
+        'samples': samples,
+        'genes': gene_names + zero_genes,
+        'zero_genes': zero_genes,
+    }
+
+
+def read_dense(output_format, path):
+    if output_format == 'npy':
+        return np.load(path)
+    if output_format == 'zarr':
+        return pytest.importorskip('zarr').open(path, mode='r')[:]
+    if output_format == 'parquet':
+        table = pytest.importorskip('pyarrow.parquet').read_table(path)
+        return np.column_stack([table.column(name).to_numpy() for name in table.column_names[1:]])
+
+
+def dense_format(output_format):
+    module = {'zarr': 'zarr', 'parquet': 'pyarrow'}.get(output_format)
+    if module is not None:
+        pytest.importorskip(module)
+
+
+@pytest.mark.parametrize('output_format', ['npy', 'zarr', 'parquet'])
+def test_export_matrix(table, tmp_path, output_format):
+    dense_format(output_format)
+    samples, gene_names, zero_genes, arr = table
+    path = export_matrix(output_format, str(tmp_path / 'out'), samples, gene_names, zero_genes,
+                         slabs(arr, 10))
+    assert path == str(tmp_path / 'out') + export.FORMATS[output_format]
+    out = read_dense(output_format, path)
+    assert out.dtype == np.int8
+    np.testing.assert_array_equal(out, dense(arr, zero_genes))
+    check_metadata(path, samples, gene_names, zero_genes)
+
+
+def test_export_matrix_parquet_columns(table, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    samples, gene_names, zero_genes, arr = table
+    path = export_matrix('parquet', str(tmp_path / 'out'), samples, gene_names, zero_genes,
+                         slabs(arr, 10))
+    parquet = pq.ParquetFile(path)
+    assert parquet.schema_arrow.names == ['s'] + gene_names + zero_genes
+    assert parquet.num_row_groups == 4
+    assert parquet.read().column('s').to_pylist() == samples
+
+
+@pytest.mark.parametrize('output_format', ['tsv', 'npz', 'long-parquet'])
+def test_export_matrix_unknown_format(table, tmp_path, output_format):
+    samples, gene_names, zero_genes, arr = table
+    with pytest.raises(ValueError):
+        export_matrix(output_format, str(tmp_path / 'out'), samples, gene_names, zero_genes,
+                      slabs(arr, 10))
+
+
+def coo(arr):
+    rows, cols = np.nonzero(arr)
+    # entries are collected in no particular order
+    order = np.random.default_rng(1).permutation(len(rows))
+    return rows[order].astype(np.int64), cols[order].astype(np.int32), arr[rows, cols][order]
+
+
+@pytest.mark.parametrize('slab_size', [1, 10, 100])
+def test_sparse_slabs(table, slab_size):
+    samples, gene_names, zero_genes, arr = table
+    out = list(sparse_slabs(coo(arr), arr.shape, slab_size=slab_size))
+    assert [start for start, _ in out] == list(range(0, arr.shape[0], slab_size))
+    np.testing.assert_array_equal(np.vstack([slab for _, slab in out]), arr)
+
+
+def test_sparse_slabs_empty():
+    empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int8)
+    (start, arr), = sparse_slabs(empty, (3, 2))
+    assert start == 0
+    np.testing.assert_array_equal(arr, np.zeros((3, 2), dtype=np.int8))
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'npy', 'zarr', 'parquet'])
+def test_export_sparse_dense_formats(table, tmp_path, output_format):
+    dense_format(output_format)
+    samples, gene_names, zero_genes, arr = table
+    path = export_sparse(output_format, str(tmp_path / 'out'), samples, gene_names, zero_genes,
+                         coo(arr), n_threads=2)
+    if output_format == 'csv':
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == baseline_csv(samples, gene_names, zero_genes, arr)
+    else:
+        np.testing.assert_array_equal(read_dense(output_format, path), dense(arr, zero_genes))
+        check_metadata(path, samples, gene_names, zero_genes)
+
+
+def test_export_sparse_npz(table, tmp_path):
+    scipy_sparse = pytest.importorskip('scipy.sparse')
+    samples, gene_names, zero_genes, arr = table
+    path = export_sparse('npz', str(tmp_path / 'out'), samples, gene_names, zero_genes, coo(arr))
+    assert path.endswith('.npz')
+    matrix = scipy_sparse.load_npz(path)
+    assert matrix.format == 'csr'
+    np.testing.assert_array_equal(matrix.toarray(), dense(arr, zero_genes))
+    check_metadata(path, samples, gene_names, zero_genes)
+
+
+def test_export_sparse_long_parquet(table, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    samples, gene_names, zero_genes, arr = table
+    path = export_sparse('long-parquet', str(tmp_path / 'out'), samples, gene_names, zero_genes,
+                         coo(arr))
+    assert path.endswith('.long.parquet')
+    cells = pq.read_table(path).to_pylist()
+    assert len(cells) == np.count_nonzero(arr)
+    out = np.zeros((len(samples), len(gene_names) + len(zero_genes)), dtype=np.int8)
+    for cell in cells:
+        out[samples.index(cell['s']), gene_names.index(cell['gene'])] = cell['value']
+    np.testing.assert_array_equal(out, dense(arr, zero_genes))
+    check_metadata(path, samples, gene_names, zero_genes)
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from analysis.utils import load_spark
+from analysis.utils.load_spark import PROFILES, init_kwargs, overrides, spark_conf
+
+GB = 2 ** 30
+
+
+@pytest.fixture
+def environment(monkeypatch, tmp_path):
+    # a local node with 8 cores and 64 GB, no config file
+    monkeypatch.setattr(load_spark, 'PLATFORM', 'local')
+    monkeypatch.setattr(load_spark, 'node_resources', lambda: (8, 64 * GB))
+    monkeypatch.setenv('ANALYSIS_SPARK_CONFIG', str(tmp_path / 'spark.json'))
+    for name in ('ANALYSIS_SPARK_CONF', 'ANALYSIS_NODES', 'SLURM_NNODES'):
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+def test_spark_conf_local(environment):
+    conf = spark_conf('annotate', 8, 64 * GB)
+    # driver and executor memory (0.25 + 0.35), the driver runs the tasks
+    assert conf['spark.driver.memory'] == '38G'
+    assert 'spark.executor.memory' not in conf
+    assert 'spark.default.parallelism' not in conf
+    assert 'spark.serializer' not in conf
+    assert 'spark.memory.offHeap.enabled' not in conf
+
+
+def test_spark_conf_local_leaves_room_for_off_heap(environment):
+    # 0.6 + 0.3 of the memory, capped at 0.75 - 0.1 of off-heap memory
+    assert spark_conf('aggregate', 8, 100 * GB)['spark.driver.memory'] == '65G'
+
+
+def test_spark_conf_cluster(environment, monkeypatch):
+    monkeypatch.setattr(load_spark, 'PLATFORM', 'aws')
+    conf = spark_conf('aggregate', 8, 100 * GB, n_nodes=3)
+    assert conf['spark.driver.memory'] == '30G'
+    assert conf['spark.executor.cores'] == '8'
+    assert conf['spark.executor.memory'] == '60G'
+    assert conf['spark.executor.memoryOverhead'] == '10G'
+    assert conf['spark.default.parallelism'] == conf['spark.sql.shuffle.partitions'] == '96'
+    assert conf['spark.serializer'] == 'org.apache.spark.serializer.KryoSerializer'
+    assert conf['spark.memory.offHeap.enabled'] == 'true'
+    assert conf['spark.memory.offHeap.size'] == '10G'
+    assert 'spark.driver.maxResultSize' not in conf
+
+
+def test_spark_conf_export(environment):
+    conf = spark_conf('export', 8, 100 * GB)
+    assert conf['spark.driver.maxResultSize'] == '25G'
+    assert 'spark.memory.offHeap.enabled' not in conf
+
+
+def test_spark_conf_at_least_a_gigabyte(environment):
+    assert spark_conf('annotate', 1, GB)['spark.driver.memory'] == '1G'
+
+
+def test_overrides(environment, monkeypatch):
+    (environment / 'spark.json').write_text(json.dumps({
+        'default': {'spark.rpc.message.maxSize': '512', 'local_tmpdir': '/scratch'},
+        'export': {'spark.rpc.message.maxSize': '1024'},
+    }))
+    assert overrides('aggregate') == {'spark.rpc.message.maxSize': '512', 'local_tmpdir': '/scratch'}
+    assert overrides('export')['spark.rpc.message.maxSize'] == '1024'
+
+    monkeypatch.setenv('ANALYSIS_SPARK_CONF', 'spark.rpc.message.maxSize = 2048,,spark.a=b=c')
+    assert overrides('export') == {
+        'spark.rpc.message.maxSize': '2048', 'local_tmpdir': '/scratch', 'spark.a': 'b=c',
+    }
+
+
+def test_overrides_without_config(environment):
+    assert overrides('aggregate') == {}
+
+
+def test_init_kwargs(environment, monkeypatch):
+    (environment / 'spark.json').write_text(json.dumps({
+        'default': {'spark.driver.memory': '4G', 'local_tmpdir': '/scratch'},
+    }))
+    monkeypatch.setenv('ANALYSIS_NODES', '2')
+    kwargs = init_kwargs('aggregate')
+    assert kwargs['master'] == 'local[8]'
+    assert kwargs['default_reference'] == 'GRCh38'
+    assert kwargs['local_tmpdir'] == '/scratch'
+    assert kwargs['spark_conf']['spark.driver.memory'] == '4G'
+    assert kwargs['spark_conf']['spark.default.parallelism'] == '64'
+    assert 'local_tmpdir' not in kwargs['spark_conf']
+
+
+def test_init_kwargs_aws(environment, monkeypatch):
+    monkeypatch.setattr(load_spark, 'PLATFORM', 'aws')
+    kwargs = init_kwargs('annotate')
+    assert 'master' not in kwargs
+    assert kwargs['spark_conf']['spark.executor.cores'] == '8'
+
+
+@pytest.mark.parametrize('platform, profile', [('local', 'unknown'), ('unknown', 'annotate')])
+def test_init_kwargs_unknown(environment, monkeypatch, platform, profile):
+    monkeypatch.setattr(load_spark, 'PLATFORM', platform)
+    with pytest.raises(ValueError):
+        init_kwargs(profile)
+
+
+def test_profiles():
+    for name, profile in PROFILES.items():
+        assert profile['executor_memory'] + profile['memory_overhead'] + profile['off_heap'] <= 1, name
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from analysis.utils.masks import DEFAULT_MASKS, MASKS, Mask, parse_masks, prefilter
+
+
+def test_parse_masks_names():
+    masks = parse_masks('hc_lof,any_lof')
+    assert [mask.name for mask in masks] == ['hc_lof', 'any_lof']
+    assert [mask.name for mask in parse_masks(','.join(DEFAULT_MASKS))] == ['hc_lof']
+    with pytest.raises(ValueError, match='Unknown masks nope'):
+        parse_masks('hc_lof,nope')
+    with pytest.raises(ValueError, match='not unique'):
+        parse_masks('hc_lof,hc_lof')
+
+
+def test_parse_masks_file(tmp_path):
+    path = tmp_path / 'masks.json'
+    path.write_text(json.dumps([
+        {'name': 'lof_mis', 'consequences': ['missense_variant'], 'max_maf': 0.01, 'encoding': 'carrier'},
+        {'name': 'lc', 'lof': ['LC'], 'encoding': 'count'},
+    ]))
+    lof_mis, lc = parse_masks(str(path))
+    assert lof_mis.spec() == {
+        'name': 'lof_mis', 'lof': ['HC'], 'consequences': ['missense_variant'],
+        'max_maf': 0.01, 'encoding': 'carrier',
+    }
+    assert lc.spec() == {'name': 'lc', 'lof': ['LC'], 'consequences': [], 'max_maf': None, 'encoding': 'count'}
+
+
+def test_mask_arguments():
+    with pytest.raises(ValueError, match='needs lof or consequences'):
+        Mask('empty', lof=())
+    with pytest.raises(ValueError, match='Unknown encoding'):
+        Mask('bad', encoding='sum')
+    assert MASKS['hc_lof'].spec() == {
+        'name': 'hc_lof', 'lof': ['HC'], 'consequences': [], 'max_maf': None, 'encoding': 'dosage',
+    }
+
+
+@pytest.fixture
+def transcripts():
+    hl = pytest.importorskip('hail')
+    tc_type = hl.tstruct(lof=hl.tstr, consequence_terms=hl.tarray(hl.tstr))
+    return hl, [
+        hl.literal(hl.Struct(lof=lof, consequence_terms=terms), tc_type)
+        for lof, terms in [
+            ('HC', ['stop_gained']),
+            ('LC', ['stop_gained']),
+            (None, ['missense_variant']),
+            (None, ['synonymous_variant']),
+            (None, None),
+        ]
+    ]
+
+
+def test_mask_qualifies(transcripts):
+    hl, tcs = transcripts
+    assert hl.eval([MASKS['hc_lof'].qualifies(tc) for tc in tcs]) == [True, False, False, False, False]
+    assert hl.eval([MASKS['any_lof'].qualifies(tc) for tc in tcs]) == [True, True, False, False, False]
+    assert hl.eval([MASKS['hc_lof_missense'].qualifies(tc) for tc in tcs]) == [
+        True, False, True, False, False,
+    ]
+
+
+def test_prefilter(transcripts):
+    hl, tcs = transcripts
+    # LOFTEE annotated rows are kept whichever the masks, as in the
+    # single mask tables
+    assert hl.eval([prefilter([MASKS['hc_lof']], tc) for tc in tcs]) == [True, True, False, False, False]
+    assert hl.eval([prefilter([MASKS['hc_lof'], MASKS['hc_lof_missense']], tc) for tc in tcs]) == [
+        True, True, True, False, False,
+    ]
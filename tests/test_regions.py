@@ -0,0 +1,80 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from analysis.utils.regions import BlockIndex, Region, bin_start, read_bed, read_tabix, to_intervals
+
+DATA = Path(__file__).parent / 'data'
+
+
+def test_read_tabix():
+    # records at chr1:100001, 110000, 150000 and 163000, written by bgzip
+    # and indexed by tabix; windows 7 and 8 are empty
+    assert read_tabix(DATA / 'block.vcf.gz.tbi') == {'chr1': (6 * 2 ** 14 + 1, 10 * 2 ** 14, 4)}
+
+
+def test_read_tabix_not_an_index(tmp_path):
+    path = tmp_path / 'block.vcf.gz.tbi'
+    shutil.copy(DATA / 'block.vcf.gz', path)
+    with pytest.raises(ValueError):
+        read_tabix(path)
+
+
+def test_bin_start():
+    assert bin_start(0) == 0
+    assert bin_start(4681) == 0
+    assert bin_start(4681 + 6) == 6 * 2 ** 14
+    assert bin_start(585 + 1) == 2 ** 17
+
+
+def test_read_bed(tmp_path):
+    bed = tmp_path / 'regions.bed'
+    bed.write_text('track name=test\n# comment\n\n1\t999\t2000\tGENE\nchr2\t0\t10\n')
+    assert read_bed(bed) == [Region('chr1', 1000, 2000), Region('chr2', 1, 10)]
+
+
+def test_to_intervals():
+    hl = pytest.importorskip('hail')
+    intervals = to_intervals([Region('chr1', 0, 2000), Region('chrM', 100, 10 ** 9)])
+    assert intervals[0] == hl.Interval(
+        hl.Locus('chr1', 1, 'GRCh38'), hl.Locus('chr1', 2000, 'GRCh38'), includes_end=True,
+    )
+    assert intervals[1].end == hl.Locus('chrM', 16569, 'GRCh38')
+
+
+@pytest.fixture
+def block_index(tmp_path):
+    index = BlockIndex(tmp_path / BlockIndex.FILE_NAME)
+    assert index.add_vcf('ukb23157_c1_b0_v1.mt', DATA / 'block.vcf.gz')
+    assert not index.add_vcf('ukb23157_c1_b1_v1.mt', tmp_path / 'missing.vcf.gz')
+    index.blocks['ukb23157_c1_b1_v1.mt'] = {
+        'contig': 'chr1', 'start': 200001, 'end': 300000, 'n_variants': None, 'source': 'mt',
+        'genes': {'GENE1': [250000, 260000]},
+    }
+    index.blocks['ukb23157_c2_b0_v1.mt'] = {
+        'contig': 'chr2', 'start': 1, 'end': 100000, 'n_variants': None, 'source': 'mt',
+        'genes': {'GENE2': [5000, 6000]},
+    }
+    return index
+
+
+def test_block_index_add_vcf(block_index):
+    assert block_index.blocks['ukb23157_c1_b0_v1.mt'] == {
+        'contig': 'chr1', 'start': 98305, 'end': 163840, 'n_variants': 4, 'source': 'tbi',
+    }
+
+
+def test_block_index_select(block_index, tmp_path):
+    bed = tmp_path / 'regions.bed'
+    bed.write_text('2\t4000\t4500\n')
+    regions, blocks = block_index.select(['1:90000-98000', 'chr1:98000-98305'])
+    assert blocks == ['ukb23157_c1_b0_v1.mt']
+    regions, blocks = block_index.select(['GENE1', str(bed)])
+    assert regions == [Region('chr2', 4001, 4500), Region('chr1', 250000, 260000)]
+    assert blocks == ['ukb23157_c1_b1_v1.mt', 'ukb23157_c2_b0_v1.mt']
+    regions, blocks = block_index.select(['ukb23157_c1_b0_v1'])
+    assert regions == [Region('chr1', 98305, 163840)]
+    assert blocks == ['ukb23157_c1_b0_v1.mt']
+    with pytest.raises(ValueError, match='GENE3'):
+        block_index.select(['GENE3'])
@@ -0,0 +1,84 @@
+import time
+import threading
+
+from analysis.utils.scheduler import BlockScheduler, run_parallel
+
+
+def test_run_order():
+    # later blocks finish first, results keep the order of the blocks
+    def process(block, staged):
+        time.sleep(0.01 * (5 - block))
+        return block * 10, staged
+
+    results = BlockScheduler(n_workers=3, n_prefetch=2).run(
+        range(5), process, stage=lambda block: f'staged-{block}',
+    )
+    assert list(results) == [0, 1, 2, 3, 4]
+    assert results == {block: (block * 10, f'staged-{block}') for block in range(5)}
+
+
+def test_run_bounds():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def process(block, staged):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    BlockScheduler(n_workers=2, n_prefetch=3).run(range(10), process, stage=lambda block: block)
+    assert running[1] == 2
+
+
+def test_run_exceptions():
+    calls = []
+    released = []
+
+    def stage(block):
+        if block == 'bad stage':
+            raise OSError(block)
+        return block
+
+    def process(block, staged):
+        calls.append(block)
+        if block == 'bad':
+            raise ValueError(block)
+        return 'ok'
+
+    results = BlockScheduler(n_workers=2).run(
+        ['a', 'bad', 'bad stage', 'b'], process, stage=stage,
+        release=lambda block, staged: released.append((block, staged)),
+    )
+    assert results['a'] == results['b'] == 'ok'
+    assert isinstance(results['bad'], ValueError)
+    assert isinstance(results['bad stage'], OSError)
+    # failed blocks are processed once, and released unless nothing was staged
+    assert sorted(calls) == ['a', 'b', 'bad']
+    assert sorted(released) == [('a', 'a'), ('b', 'b'), ('bad', 'bad')]
+
+
+def test_run_retry_failed():
+    attempts = {}
+
+    def flaky(block, staged):
+        attempts[block] = attempts.get(block, 0) + 1
+        if block % 2 and attempts[block] == 1:
+            raise RuntimeError(f'{block} failed')
+        return block
+
+    scheduler = BlockScheduler(n_workers=2)
+    results = scheduler.run(range(4), flaky)
+    failed = [block for block, result in results.items() if isinstance(result, Exception)]
+    assert failed == [1, 3]
+    assert scheduler.run(failed, flaky) == {1: 1, 3: 3}
+    assert attempts == {0: 1, 1: 2, 2: 1, 3: 2}
+
+
+def test_run_parallel():
+    results = run_parallel(['1', 'x', '3'], int, n_workers=2)
+    assert results['1'] == 1 and results['3'] == 3
+    assert isinstance(results['x'], ValueError)
+    assert list(results) == ['1', 'x', '3']
@@ -0,0 +1,110 @@
+import pytest
+from pathlib import Path
+
+from analysis.utils import dxpathlib
+from analysis.utils.dxpathlib import PathDx, TTLCache
+from analysis.utils.storage import LocalBackend
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    backend = PathDx.backend
+    local = LocalBackend(tmp_path / 'dnax', page_size=2)
+    PathDx.set_backend(local)
+    local.create_database('test_database')
+    yield local
+    PathDx.set_backend(backend)
+
+
+@pytest.fixture
+def test_database_path(local_backend):
+    root = PathDx(database='test_database')
+    folder = Path(local_backend.root) / root.database_id
+    for name in ('a.ht', 'b.mt', 'c.mt'):
+        (folder / name).mkdir()
+    (folder / 'b.mt' / '_SUCCESS').touch()
+    return root
+
+
+def test_find_database(local_backend):
+    local_backend.create_database('other_database')
+    db = PathDx.find_database('test_database')
+    assert db['name'] == 'test_database'
+    assert PathDx(database=db['id']).rstr == PathDx(database='test_database').rstr
+    with pytest.raises(ValueError):
+        PathDx(database='i_dont_exist')
+
+
+def test_local_paths(local_backend, test_database_path):
+    p = test_database_path / 'a.ht'
+    assert str(p) == f'dnax://{p.database_id}/a.ht'
+    assert p.rstr == f'file://{local_backend.root}/{p.database_id}/a.ht'
+
+
+def test_listdir(local_backend, test_database_path):
+    names = [p.name for p in test_database_path.listdir()]
+    assert names == ['a.ht', 'b.mt', 'c.mt']
+    assert [p.name for p in (test_database_path / 'b.mt').listdir()] == ['_SUCCESS']
+    with pytest.raises(Warning):
+        (test_database_path / 'a.ht').listdir()
+
+
+def test_hidden_files(local_backend, test_database_path):
+    folder = {'folder': 'b.mt'}
+    assert local_backend.list_folder(test_database_path.database_id, folder)['results'] == []
+
+
+def test_listing_cache(local_backend, test_database_path):
+    local_backend.reset_stats()
+    test_database_path.listdir()
+    # three names, two per page
+    assert local_backend.stats()['list_folder']['calls'] == 2
+    test_database_path.listdir()
+    assert local_backend.stats()['list_folder']['calls'] == 2
+    (test_database_path / 'a.ht').invalidate()
+    test_database_path.listdir()
+    assert local_backend.stats()['list_folder']['calls'] == 4
+
+
+def test_ttl_cache(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(dxpathlib.time, 'monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b', 'default') == 'default'
+    now[0] = 110.5
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    # 'b' is the least recently used
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    cache.invalidate(lambda key: key == 'a')
+    assert (cache.get('a'), cache.get('c')) == (None, 3)
+    cache.invalidate()
+    assert cache.get('c') is None
+
+
+def test_iter_folder_pages(local_backend, test_database_path):
+    folder = Path(local_backend.root) / test_database_path.database_id
+    for name in ('d.ht', 'e.ht'):
+        (folder / name).mkdir()
+    local_backend.reset_stats()
+    # a listing read partly isn't cached
+    listing = test_database_path._iter_folder()
+    next(listing)
+    listing.close()
+    assert local_backend.stats()['list_folder']['calls'] == 1
+    # five names, two per page
+    names = [result['path'].rsplit('/', 1)[-1] for result in test_database_path._iter_folder()]
+    assert names == ['a.ht', 'b.mt', 'c.mt', 'd.ht', 'e.ht']
+    assert local_backend.stats()['list_folder']['calls'] == 4
+    assert len(list(test_database_path._iter_folder())) == 5
+    assert local_backend.stats()['list_folder']['calls'] == 4
+
+
+def test_iter_folder_empty(local_backend, test_database_path):
+    with pytest.raises(Warning):
+        list((test_database_path / 'missing').listdir())
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from analysis.utils.dxpathlib import PathDx
+
+hl = pytest.importorskip('hail')
+
+from analysis.utils.vep_cache import VEPCache, vep_versions  # noqa: E402
+
+
+def test_vep_versions():
+    config = {'command': ['docker', 'run', 'ensembl-vep:release_105.0', 'vep']}
+    assert vep_versions(config) == {'vep': '105.0', 'loftee': 'v1.0.4_GRCh38'}
+
+
+@pytest.fixture
+def vep_cache(tmp_path):
+    config_path = tmp_path / 'vep.json'
+    config_path.write_text(json.dumps({
+        'command': ['vep', '--format', 'vcf', '--json'],
+        'vep_json_schema': 'Struct{gene:String}',
+    }))
+    return VEPCache(PathDx(tmp_path), config_path, max_parts=2)
+
+
+def sites(positions):
+    ht = hl.Table.parallelize(
+        [{'locus': hl.Locus('chr1', pos, 'GRCh38'), 'alleles': ['A', 'T']} for pos in positions],
+        hl.tstruct(locus=hl.tlocus('GRCh38'), alleles=hl.tarray(hl.tstr)),
+        key=['locus', 'alleles'],
+    )
+    return ht.annotate(vep=hl.struct(gene=hl.str(ht.locus.position)))
+
+
+def add_part(vep_cache, positions):
+    path, n_rows = vep_cache._write(sites(positions), 'chr1')
+    vep_cache.index.update(path.name, status='done', contig='chr1', n_rows=n_rows)
+    return path
+
+
+def test_lookup_cached_sites_writes_no_part(vep_cache, tmp_path):
+    add_part(vep_cache, [1, 2])
+    vep_ht = vep_cache.lookup(sites([1, 2]), tmp_path / 'vep.json', 'chr1')
+    assert vep_ht.count() == 2
+    assert vep_cache.parts('chr1') == [f'vep-{vep_cache.key}-chr1-0.ht']
+    assert not (tmp_path / f'vep-{vep_cache.key}-chr1-1.ht').exists()
+
+
+def test_remove_merged(vep_cache, tmp_path):
+    parts = [add_part(vep_cache, [pos]) for pos in (1, 2, 3)]
+    vep_cache.compact('chr1')
+    merged = vep_cache.parts('chr1')
+    assert merged == [f'vep-{vep_cache.key}-chr1-3.ht']
+    assert all(os.path.exists(path) for path in parts)
+
+    vep_cache.remove_merged()
+    assert not any(os.path.exists(path) for path in parts)
+    assert all(vep_cache.index.get(path.name)['status'] == 'removed' for path in parts)
+    assert vep_cache.read('chr1').count() == 3
+
+    # part names aren't reused by a new cache on the same index
+    reopened = VEPCache(PathDx(tmp_path), tmp_path / 'vep.json', max_parts=2)
+    assert add_part(reopened, [4]).name == f'vep-{vep_cache.key}-chr1-4.ht'
@@ -0,0 +1,135 @@
+import sys
+import json
+import socket
+import argparse
+import threading
+
+import pytest
+
+from analysis.utils import vep_service
+from analysis.utils.vep_service import FLUSH_ID, VEPWorker, recv_frame, send_frame
+
+# Stand-in for VEP: reads --buffer_size records at a time and writes a
+# chunk out only once the next one is read, or exits on a FAIL record.
+# With $FAKE_VEP_INPUT it keeps a copy of its input.
+FAKE_VEP = '''
+import os, sys
+n = int(sys.argv[sys.argv.index('--buffer_size') + 1])
+copy = open(os.environ['FAKE_VEP_INPUT'], 'w') if os.environ.get('FAKE_VEP_INPUT') else None
+chunk, done = [], []
+for line in sys.stdin:
+    if copy:
+        copy.write(line)
+        copy.flush()
+    if line.startswith('#'):
+        continue
+    if 'FAIL' in line:
+        sys.exit(3)
+    chunk.append(line)
+    if len(chunk) == n:
+        sys.stdout.write(''.join(done))
+        sys.stdout.flush()
+        chunk, done = [], chunk
+'''
+
+
+def records(*ids):
+    return b''.join(b'chr1\t%d\t%s\tC\tT\t.\t.\t.\n' % (i, i_d.encode()) for i, i_d in enumerate(ids, 1))
+
+
+def test_frames():
+    a, b = socket.socketpair()
+    with a, b:
+        for data in (b'', b'0', b'x' * (3 * 2 ** 20)):
+            sender = threading.Thread(target=send_frame, args=(a, data))
+            sender.start()
+            assert recv_frame(b) == data
+            sender.join()
+        a.close()
+        with pytest.raises(ConnectionError):
+            recv_frame(b)
+
+
+def test_flush_record(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_VEP_INPUT', str(tmp_path / 'input.vcf'))
+    worker = VEPWorker([sys.executable, '-c', FAKE_VEP], None, buffer_size=3)
+    try:
+        worker.annotate(records('a'))
+    finally:
+        worker.close()
+    lines = (tmp_path / 'input.vcf').read_bytes().splitlines(keepends=True)
+    assert lines[2:] == [b'chr1\t1\ta\tC\tT\t.\t.\t.\n'] + 6 * [
+        b'chr1\t69134\tvep_service_flush_1_end\tA\tG\t.\t.\t.\n'
+    ]
+
+
+def test_flush_detection():
+    worker = VEPWorker([sys.executable, '-c', FAKE_VEP], None, buffer_size=3)
+    try:
+        # the records end on a chunk boundary, the rest of the flush
+        # records of one batch are skipped in the next
+        assert worker.annotate(records('a', 'b', 'c')) == records('a', 'b', 'c').splitlines(keepends=True)
+        assert worker.annotate(records('d')) == [b'chr1\t1\td\tC\tT\t.\t.\t.\n']
+        for _ in range(10):
+            assert worker.annotate(b'') == []
+        assert not any(FLUSH_ID in line for line in worker.annotate(records('e', 'f')))
+    finally:
+        worker.close()
+
+
+
+def test_batch_larger_than_pipe():
+    # the input and the output are far larger than a pipe buffer
+    batch = records(*(f'variant{i}' for i in range(5000)))
+    worker = VEPWorker([sys.executable, '-c', FAKE_VEP], None, buffer_size=100)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(worker.annotate(batch)), daemon=True)
+    thread.start()
+    thread.join(30)
+    try:
+        assert not thread.is_alive()
+        assert b''.join(result[0]) == batch
+        # the leftover flush output is skipped by the next batch
+        assert b''.join(worker.annotate(records('a', 'b'))) == records('a', 'b')
+    finally:
+        worker.kill()
+
+
+@pytest.fixture
+def serve(tmp_path, monkeypatch):
+    """Start a server with one worker running the VEP stand-in script,
+    return the script's path."""
+    vep = tmp_path / 'vep'
+    vep.write_text(f'#!{sys.executable}\n{FAKE_VEP}')
+    vep.chmod(0o755)
+    config = tmp_path / 'vep-config.json'
+    config.write_text(json.dumps({'command': [str(vep)]}))
+    monkeypatch.setattr(vep_service, 'SOCKET_PATH', str(tmp_path / 'vep.sock'))
+    args = argparse.Namespace(config=str(config), workers=1, buffer_size=2, idle_timeout=1)
+    server = threading.Thread(target=vep_service.serve, args=(args,))
+    server.start()
+    for _ in range(100):
+        try:
+            vep_service.connect().close()
+            break
+        except OSError:
+            server.join(0.1)
+    yield vep
+    # idle servers stop
+    server.join(10)
+    assert not server.is_alive()
+
+
+def test_failed_worker(serve):
+    with pytest.raises(RuntimeError, match='VEP exited'):
+        vep_service.request(records('FAIL'))
+    # the worker was replaced
+    assert vep_service.request(records('a')) == records('a')
+
+
+def test_failed_worker_not_restarted(serve):
+    serve.unlink()
+    with pytest.raises(RuntimeError, match='VEP exited'):
+        vep_service.request(records('FAIL'))
+    with pytest.raises(RuntimeError, match='No VEP workers left'):
+        vep_service.request(records('a'))